@@ -24,7 +24,8 @@ async def main():
     print("-> Connected")
 
     with conn.cursor() as cur:
-        schema_raw = importlib.resources.files("jobq").joinpath("schema.sql").read_text()
+        schema_file = "schema_partitioned.sql" if int(os.environ.get(Const.Config.PARTITIONED, 0)) else "schema.sql"
+        schema_raw = importlib.resources.files("jobq").joinpath(schema_file).read_text()
         cur.execute(''.join(schema_raw))
         print("-> schema written")
         conn.commit()
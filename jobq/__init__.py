@@ -3,10 +3,12 @@ from quart import Quart
 import jobq.service
 from jobq.db import db
 from jobq.handlers.web import web as web_blueprint
+from jobq.logger import configure_logging, stop_log_queue
 
 
 class ApplicationGenerator:
     def create_app(self) -> Quart:
+        configure_logging()
         app = Quart(__name__)
 
         app.register_blueprint(web_blueprint)
@@ -20,15 +22,24 @@ class ApplicationGenerator:
     def set_startup_handlers(app: Quart) -> None:
         @app.before_serving
         async def startup():
+            # before the pool, which prepares the statements it registers on every connection
+            jobq.service.job_db.configure()
             await db.create_connection_pool()
+            if jobq.service.job_db.partitioned:
+                # jobs can't be saved before there is a partition for them
+                await jobq.service.job_db.maintain_partitions()
+            jobq.service.job_execution.configure()
             jobq.service.job_worker.start(app)
 
     @staticmethod
     def set_shutdown_handlers(app: Quart) -> None:
         @app.after_serving
         async def shutdown():
-            await db.close_connection_pool()
+            # workers finish what they are doing first, and need the DB for that
             await jobq.service.job_worker.stop()
+            jobq.service.job_execution.shutdown()
+            await db.close_connection_pool()
+            stop_log_queue()
 
 
 def create_app() -> Quart:
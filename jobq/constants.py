@@ -7,7 +7,30 @@ class Const:
         SERVER_HOST = "SERVER_HOST"
         DEBUG = "DEBUG"
         WORKER_COUNT = "WORKERS"
+        WORKER_PROCESSES = "WORKER_PROCESSES"
+        SHUTDOWN_TIMEOUT = "SHUTDOWN_TIMEOUT"
         POLLING_INTERVAL = "POLLING_INTERVAL"
+        LISTEN_NOTIFY = "LISTEN_NOTIFY"
+        BATCH_SIZE = "BATCH_SIZE"
+        BACKOFF_BASE = "BACKOFF_BASE"
+        BACKOFF_JITTER = "BACKOFF_JITTER"
+        LEASE_SECONDS = "LEASE_SECONDS"
+        REAPER_INTERVAL = "REAPER_INTERVAL"
+        CONCURRENCY = "CONCURRENCY"
+        PRIORITY_FLOORS = "PRIORITY_FLOORS"
+        WORKER_GROUPS = "WORKER_GROUPS"
+        PARTITIONED = "PARTITIONED"
+        PARTITION_HOURS = "PARTITION_HOURS"
+        HISTORY_DAYS = "HISTORY_DAYS"
+        DEAD_LETTER_DAYS = "DEAD_LETTER_DAYS"
+        JOB_EXECUTORS = "JOB_EXECUTORS"
+        THREAD_POOL_SIZE = "THREAD_POOL_SIZE"
+        PROCESS_POOL_SIZE = "PROCESS_POOL_SIZE"
+        ORJSON = "ORJSON"
+        LOG_LEVEL = "LOG_LEVEL"
+        LOG_QUEUE = "LOG_QUEUE"
+        PREPARED_STATEMENTS = "PREPARED_STATEMENTS"
+        STATEMENT_CACHE_SIZE = "STATEMENT_CACHE_SIZE"
 
         class DB:
             DB_NAME = "DB_NAME"
@@ -23,3 +46,11 @@ class Const:
     class Jobs:
         MAX_RETRIES = 3
         BASE_RETRY_MINUTES = 20
+        # how long a worker has to finish a job before it's handed to someone else
+        LEASE_SECONDS = 300
+        # the queue for jobs that don't say otherwise
+        DEFAULT_QUEUE = "default"
+        # Postgres channel a NOTIFY is sent on whenever a job is saved
+        NOTIFY_CHANNEL = "jobq_job_saved"
+        # jobs submitted over HTTP are saved this many per statement
+        SAVE_BATCH_SIZE = 1000
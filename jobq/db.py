@@ -1,18 +1,58 @@
+import contextlib
+import json
 import os
-from typing import Optional
+import time
+from typing import Any, AsyncContextManager, AsyncIterator, Callable, Optional
 
 import asyncpg  # type: ignore
 from asyncpg import Connection, Pool  # type: ignore
-from asyncpg.pool import PoolAcquireContext  # type: ignore
+from asyncpg.prepared_stmt import PreparedStatement  # type: ignore
 from quart import Quart, g, has_request_context, request
 
 from jobq.constants import Const
 from jobq.logger import logger
+from jobq.metrics import metrics
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None  # type: ignore
+
+
+def json_codec() -> tuple[Callable[[Any], str], Callable[[str | bytes], Any]]:
+    """
+    JSON encoder and decoder for JSONB columns - orjson if it is installed (and not turned off), or the standard library
+    """
+    if orjson and int(os.environ.get(Const.Config.ORJSON, 1)):
+        return (lambda obj: orjson.dumps(obj).decode()), orjson.loads
+
+    return json.dumps, json.loads
+
+
+class JobqConnection(Connection):
+    """
+    A pooled connection, with the statements registered with the connection manager prepared on it
+    """
+
+    # SQL -> its prepared statement
+    prepared: dict[str, PreparedStatement]
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = {}
 
 
 class DbConnectionManager:
     config_app: Quart
     conn_pool: Optional[Pool]
+    # SQL -> name of the statements prepared up front on every pooled connection, see register_statement()
+    statements: dict[str, str]
+    # off behind PgBouncer in transaction mode, where a statement prepared in one transaction may be
+    # gone in the next
+    prepare_statements: bool = True
+
+    def __init__(self):
+        self.statements = {}
 
     @property
     def request_connection_name(self) -> str:
@@ -28,8 +68,9 @@ class DbConnectionManager:
     def get_connection(self) -> Connection:
         return getattr(g, self.request_connection_name, None)
 
-    async def create_connection_pool(self) -> None:
-        self.conn_pool = await asyncpg.create_pool(
+    @staticmethod
+    def connection_params() -> dict:
+        return dict(
             database=os.environ.get(Const.Config.DB.DB_NAME),
             user=os.environ.get(Const.Config.DB.DB_USER),
             password=os.environ.get(Const.Config.DB.DB_PASSWORD),
@@ -37,16 +78,63 @@ class DbConnectionManager:
             port=os.environ.get(Const.Config.DB.DB_PORT),
             server_settings={"jit": "off", "application_name": "Postgres Queue Example"},
         )
-        logger.info("CREATED connection pool...")
+
+    def register_statement(self, name: str, sql: str) -> None:
+        """
+        Have a statement prepared on every pooled connection as it's opened, under its own name (as listed in
+        pg_prepared_statements). Register before the pool is created.
+        """
+        self.statements[sql] = name
+
+    async def init_connection(self, conn: Connection) -> None:
+        # JSONB goes in as Python objects and comes out as dicts, so nobody has to (de)serialize it by hand
+        encoder, decoder = json_codec()
+        await conn.set_type_codec("jsonb", encoder=encoder, decoder=decoder, schema="pg_catalog")
+
+        if self.prepare_statements and isinstance(conn, JobqConnection):
+            for sql, name in self.statements.items():
+                conn.prepared[sql] = await conn.prepare(sql, name=name)
+
+    async def create_connection_pool(self) -> None:
+        # "connection" (default) - hot statements are prepared on each pooled connection, the rest go through
+        # asyncpg's statement cache. "off" - nothing is prepared by name, and the cache is off (PgBouncer in
+        # transaction mode). PgBouncer 1.21+ with max_prepared_statements handles the default.
+        self.prepare_statements = os.environ.get(Const.Config.PREPARED_STATEMENTS, "connection") != "off"
+        cache_size = int(os.environ.get(Const.Config.STATEMENT_CACHE_SIZE, 100)) if self.prepare_statements else 0
+
+        self.conn_pool = await asyncpg.create_pool(
+            **self.connection_params(),
+            init=self.init_connection,
+            connection_class=JobqConnection,
+            statement_cache_size=cache_size,
+        )
+        logger.info(
+            f"CREATED connection pool, with {len(self.statements) if self.prepare_statements else 0} "
+            "prepared statements per connection..."
+        )
+
+    async def create_listener_connection(self) -> Connection:
+        # LISTEN is session state, so the listener gets its own connection instead of pinning one from the pool
+        conn: Connection = await asyncpg.connect(**self.connection_params())
+        logger.info("CREATED listener connection...")
+        return conn
 
     async def close_connection_pool(self) -> None:
         assert self.conn_pool
         await self.conn_pool.close()
         logger.warning("CLOSED connection pool...")
 
-    def get_connection_ctx(self) -> Optional[PoolAcquireContext]:
+    def get_connection_ctx(self) -> Optional[AsyncContextManager[Connection]]:
         assert self.conn_pool
-        return self.conn_pool.acquire()
+        return self.acquire(self.conn_pool)
+
+    @staticmethod
+    @contextlib.asynccontextmanager
+    async def acquire(pool: Pool) -> AsyncIterator[Connection]:
+        started = time.perf_counter()
+        async with pool.acquire() as conn:
+            metrics.pool_acquire_seconds.observe(time.perf_counter() - started)
+            yield conn
 
     async def close_connection(self) -> None:
         raise NotImplementedError
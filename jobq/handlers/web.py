@@ -1,13 +1,18 @@
 import datetime
 import random
+import time
 import traceback
 import uuid
+from typing import Any, Callable, Optional
 
-from quart import Blueprint, redirect, render_template, render_template_string, url_for
+from quart import Blueprint, Response, redirect, render_template, render_template_string, request, url_for
 
 import jobq.service
+from jobq.constants import Const
+from jobq.db import db, json_codec
 from jobq.logger import logger
-from jobq.models.job import Job, JobType
+from jobq.metrics import metrics
+from jobq.models.job import Job, JobState, JobType
 from jobq.transaction import read_transaction, write_transaction
 
 web = Blueprint(
@@ -30,11 +35,32 @@ async def handle_unknown_exception(ex: Exception) -> tuple[str, int]:
 @web.get("/")
 @read_transaction
 async def index():
-    jobs: list[Job] = await jobq.service.job_db.get_all_jobs()
+    state = JobState(request.args.get("state", JobState.QUEUED.value))
+    job_type: str | None = request.args.get("type") or None
+    after: str | None = request.args.get("after") or None
+    limit: int = min(max(request.args.get("limit", 50, type=int), 1), 500)
+
+    jobs, cursor = await jobq.service.job_db.get_jobs_page(limit=limit, after=after, state=state, job_type=job_type)
+    counts: dict = await jobq.service.job_db.get_job_counts()
     workers = jobq.service.job_worker.workers
 
+    next_page: str | None = None
+    if cursor:
+        next_page = url_for("web.index", state=state.value, type=job_type or "", limit=limit, after=cursor)
+
     now = datetime.datetime.utcnow()
-    return await render_template("index.html", jobs=jobs, workers=workers, time=now.strftime("%H:%M:%S"))
+    return await render_template(
+        "index.html",
+        jobs=jobs,
+        counts=counts,
+        workers=workers,
+        states=list(JobState),
+        job_types=list(JobType),
+        state=state,
+        job_type=job_type,
+        next_page=next_page,
+        time=now.strftime("%H:%M:%S"),
+    )
 
 
 @web.get("/create")
@@ -55,3 +81,158 @@ async def create():
     await jobq.service.job_db.save(job)
 
     return redirect(url_for("web.index"))
+
+
+# the fields of a job that producers can set
+API_JOB_FIELDS = {
+    "job_type",
+    "arguments",
+    "priority",
+    "queue",
+    "max_retries",
+    "base_retry_minutes",
+    "delay_seconds",
+    "idempotency_key",
+}
+
+
+def job_from_json(data: Any) -> Job:
+    if not isinstance(data, dict):
+        raise ValueError("A job must be a JSON object")
+
+    unknown: set[str] = data.keys() - API_JOB_FIELDS
+    if unknown:
+        raise ValueError(f"Unknown job fields: {', '.join(sorted(unknown))}")
+
+    fields: dict = dict(data)
+    delay_seconds = float(fields.pop("delay_seconds", None) or 0)
+    if delay_seconds < 0:
+        raise ValueError("delay_seconds can't be negative")
+
+    job: Job = Job.model_validate(fields)
+    if delay_seconds:
+        job.ripe_at = datetime.datetime.now() + datetime.timedelta(seconds=delay_seconds)
+
+    return job
+
+
+async def read_ndjson_jobs() -> list[Job]:
+    """
+    Jobs from a body with one JSON job per line, parsed as the body streams in rather than all at once at the end
+    """
+    decode = json_codec()[1]
+    jobs: list[Job] = []
+    line_number = 0
+    rest = b""
+
+    async for chunk in request.body:
+        lines: list[bytes] = (rest + chunk).split(b"\n")
+        rest = lines.pop()
+
+        for line in lines:
+            line_number += 1
+            if line.strip():
+                jobs.append(job_from_line(decode, line, line_number))
+
+    if rest.strip():
+        jobs.append(job_from_line(decode, rest, line_number + 1))
+
+    return jobs
+
+
+def job_from_line(decode: Callable[[bytes], Any], line: bytes, line_number: int) -> Job:
+    try:
+        return job_from_json(decode(line))
+    except ValueError as ex:
+        raise ValueError(f"Line {line_number}: {ex}") from ex
+
+
+@write_transaction
+async def save_jobs(jobs: list[Job]) -> list[str]:
+    # one statement per batch, all in one transaction - a request is saved whole or not at all
+    ids: list[str] = []
+    for start in range(0, len(jobs), Const.Jobs.SAVE_BATCH_SIZE):
+        end: int = start + Const.Jobs.SAVE_BATCH_SIZE
+        ids += await jobq.service.job_db.save_many(jobs[start:end])
+
+    return ids
+
+
+@web.post("/jobs")
+async def enqueue_jobs():
+    """
+    Enqueue a job ({"job_type": ..., "arguments": {...}, "delay_seconds": 60, "priority": 10, "idempotency_key": ...}),
+    a JSON array of them, or a stream of them, one per line, as application/x-ndjson.
+    The body is parsed and validated before a DB connection is taken.
+    """
+    try:
+        if request.mimetype == "application/x-ndjson":
+            return {"ids": await save_jobs(await read_ndjson_jobs())}, 201
+
+        data: Any = json_codec()[1](await request.get_data())
+        if isinstance(data, list):
+            return {"ids": await save_jobs([job_from_json(job) for job in data])}, 201
+
+        ids: list[str] = await save_jobs([job_from_json(data)])
+        return {"id": ids[0]}, 201
+    except ValueError as ex:
+        return {"error": str(ex)}, 400
+
+
+@web.get("/jobs/<uuid:job_id>")
+@read_transaction
+async def get_job(job_id: uuid.UUID):
+    job: Optional[Job] = await jobq.service.job_db.get_job(str(job_id))
+    if job:
+        return {
+            **job.model_dump(mode="json", include=set(Job.DB_FIELDS)),
+            "state": job.state().value,
+        }
+
+    # no longer in the queue - completed or dead
+    finished: Optional[dict] = await jobq.service.job_db.get_finished_job(str(job_id))
+    if finished:
+        return {
+            **{k: v.isoformat() if isinstance(v, datetime.datetime) else v for k, v in finished.items()},
+            "state": finished["status"],
+        }
+
+    return {"error": "Job not found"}, 404
+
+
+@web.delete("/jobs/<uuid:job_id>")
+async def cancel_job(job_id: uuid.UUID):
+    cancelled: Optional[bool] = await jobq.service.job_db.cancel_job(str(job_id))
+
+    if cancelled is None:
+        return {"error": "Job not found"}, 404
+
+    if not cancelled:
+        return {"error": "Job is running"}, 409
+
+    return "", 204
+
+
+@read_transaction
+async def sample_queue_metrics() -> None:
+    counts: dict = await jobq.service.job_db.get_job_counts()
+    for state in ("ripe", "scheduled", "running"):
+        if counts[state] is not None:
+            metrics.queued_jobs.set(counts[state], state)
+    metrics.queued_jobs.set(counts["queued"], "queued")
+
+    metrics.oldest_ripe_job_seconds.set(await jobq.service.job_db.get_oldest_ripe_job_seconds())
+
+
+@web.get("/metrics")
+async def get_metrics():
+    if metrics.sample_is_stale():
+        await sample_queue_metrics()
+        metrics.sampled_at = time.monotonic()
+
+    pool = getattr(db.connection_manager, "conn_pool", None)
+    if pool:
+        metrics.pool_connections.set(pool.get_size() - pool.get_idle_size(), "in_use")
+        metrics.pool_connections.set(pool.get_idle_size(), "idle")
+
+    return Response(metrics.render(), content_type="text/plain; version=0.0.4")
@@ -1,114 +1,302 @@
 import asyncio
 import logging
 import os
+import random
+import socket
+import time
 from typing import Optional
 
 from quart import Quart, request
-from siftlog import SiftLog  # type: ignore
 
 import jobq.service
 from jobq.constants import Const
+from jobq.logger import JobqLog
+from jobq.metrics import metrics
 from jobq.models.job import Job
-from jobq.transaction import write_transaction
 
 
 class JobWorker:
     app: Quart
     worker_id: int
-    logger: SiftLog
+    # the worker only claims jobs from this queue
+    queue: str
+    # settings of the worker group, taking precedence over the environment
+    settings: dict
+    # how many jobs to claim per round trip
+    batch_size: int
+    # the name jobs are leased under, unique across hosts and processes
+    lease_owner: str
+    lease_seconds: int
+    # how many jobs the worker runs at the same time
+    concurrency: int
+    # the worker only claims jobs of this priority or higher (None for all jobs)
+    min_priority: Optional[int]
+    _in_flight: set[asyncio.Task]
+    # claims in a row that came back empty
+    _empty_polls: int
+    logger: JobqLog
     _stop_flag: bool
+    _wake_up: asyncio.Event
     stopped: bool
-    polling_interval = int(os.environ.get(Const.Config.POLLING_INTERVAL, 5))
+    # waiting for a wake-up call or the polling interval, not working on a job
+    idle: bool
+    # the longest the worker sleeps when there is nothing to do
+    polling_interval: float
+    # first sleep after an empty pull, doubling with each empty pull up to the polling interval
+    backoff_base: float
+    # how much of each sleep can be randomly shaved off, so idle workers don't poll in lockstep (0 to 1)
+    backoff_jitter: float
     # after each X sleep cycles, the worker will squak
     sound_off_every_cycles = 100
 
-    def __init__(self, worker_id, app: Quart):
+    def __init__(
+        self,
+        worker_id,
+        app: Quart,
+        min_priority: Optional[int] = None,
+        queue: str = Const.Jobs.DEFAULT_QUEUE,
+        settings: Optional[dict] = None,
+    ):
         self._stop_flag = False
         self.worker_id = worker_id
+        self.min_priority = min_priority
+        self.queue = queue
+        self.settings = settings or {}
+        self.batch_size = int(self.setting(Const.Config.BATCH_SIZE, 1))
+        self.lease_owner = f"{socket.gethostname()}:{os.getpid()}#{worker_id}"
+        self.lease_seconds = int(self.setting(Const.Config.LEASE_SECONDS, Const.Jobs.LEASE_SECONDS))
+        self.concurrency = int(self.setting(Const.Config.CONCURRENCY, 1))
+        self._in_flight = set()
+        self._empty_polls = 0
+        self.polling_interval = float(self.setting(Const.Config.POLLING_INTERVAL, 5))
+        self.backoff_base = float(self.setting(Const.Config.BACKOFF_BASE, 0.1))
+        self.backoff_jitter = float(self.setting(Const.Config.BACKOFF_JITTER, 0.5))
+        self._wake_up = asyncio.Event()
         self.stopped = True
+        self.idle = False
         self.app = app
 
         core_logger = logging.getLogger(Const.LOG_NAME)
 
         # A worker has its own log instance as it has persistent properties to be logged (worker id)
-        self.logger = SiftLog(
+        self.logger = JobqLog(
             core_logger,
             worker_id=f"#{self.worker_id}",
+            queue=self.queue,
         )
 
+    def setting(self, key: str, default):
+        return self.settings.get(key, os.environ.get(key, default))
+
     def request_stop(self):
         self.logger.info("Telling worker to stop")
         self._stop_flag = True
+        self.wake_up()
+
+    def wake_up(self):
+        # cut the current wait short. If the worker is busy, it will pull again as soon as it's done
+        self._wake_up.set()
+
+    def takes_priority(self, priority: Optional[int]) -> bool:
+        # a job of unknown priority is only for workers that take everything in their queue
+        if self.min_priority is None:
+            return True
+        return priority is not None and priority >= self.min_priority
+
+    def backoff(self, empty_pulls: int) -> float:
+        delay = min(self.polling_interval, self.backoff_base * pow(2, empty_pulls - 1))
+        return delay - delay * self.backoff_jitter * random.random()
+
+    async def wait(self, timeout: float):
+        self.idle = True
+
+        try:
+            await asyncio.wait_for(self._wake_up.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+        self._wake_up.clear()
+        self.idle = False
 
     async def run(self):
         self.logger.info("Starting worker")
         self.stopped = False
 
         sound_off_cycles = 0
+        empty_pulls = 0
 
         while not self._stop_flag:
-            sound_off_cycles = sound_off_cycles + 1
-            if sound_off_cycles >= self.sound_off_every_cycles:
-                self.logger.info("Worker is still in the fight!")
-                sound_off_cycles = 0
-
-            await asyncio.sleep(self.polling_interval)
-
-            if self._stop_flag:
-                continue
+            if self.concurrency > 1:
+                await self._wait_for_free_slot()
 
             # A little unorthodox to use a test method, but it's just a wrapper that sets
             # the boring defaults to create request context (we need access to Quart.g - global
             # request context - to store connection info in)
             async with self.app.test_request_context("/job_worker"):
                 setattr(request, "index", self.worker_id)
-                await self.pull_and_execute()
+
+                if self.concurrency > 1:
+                    got_work = bool(await self.pull_and_dispatch())
+                else:
+                    got_work = bool(await self.pull_and_execute_batch())
+
+            # drain the queue - as long as there are ripe jobs, pull again right away
+            if got_work:
+                empty_pulls = 0
+                continue
+
+            if self._stop_flag:
+                continue
+
+            sound_off_cycles = sound_off_cycles + 1
+            if sound_off_cycles >= self.sound_off_every_cycles:
+                self.logger.info("Worker is still in the fight!")
+                sound_off_cycles = 0
+
+            empty_pulls = empty_pulls + 1
+            await self.wait(self.backoff(empty_pulls))
+
+        await self.drain()
 
         self.stopped = True
         self.logger.info("Worker is done")
 
+    async def drain(self):
+        if self._in_flight:
+            self.logger.info(f"Waiting for {len(self._in_flight)} jobs in flight")
+            await asyncio.wait(self._in_flight)
+
+    async def _wait_for_free_slot(self):
+        if len(self._in_flight) >= self.concurrency:
+            await asyncio.wait(self._in_flight, return_when=asyncio.FIRST_COMPLETED)
+
     async def pull_and_execute(self) -> Optional[Job]:
+        jobs: list[Job] = await self.pull_and_execute_batch(limit=1)
+        return jobs[0] if jobs else None
+
+    async def pull_and_execute_batch(self, limit: Optional[int] = None) -> list[Job]:
+        try:
+            jobs: list[Job] = await self._claim(limit or self.batch_size)
+
+            # The jobs are leased to this worker now - no DB connection or transaction is held while they run
+            for job in jobs:
+                await self._execute(job)
+
+            # all outcomes of the batch go back in one statement
+            await self._release(jobs)
+            return jobs
+        except Exception as ex:
+            # important to swallow all exceptions so the worker does not exit
+            self.logger.exception(str(ex))
+
+        return []
+
+    async def pull_and_dispatch(self) -> list[Job]:
+        """
+        Claim as many jobs as there are free slots, and run each one in its own task
+        """
+        free_slots = self.concurrency - len(self._in_flight)
+        if free_slots < 1:
+            return []
+
         try:
-            return await self._pull_and_execute()
+            jobs: list[Job] = await self._claim(min(self.batch_size, free_slots))
         except Exception as ex:
             # important to swallow all exceptions so the worker does not exit
             self.logger.exception(str(ex))
+            return []
+
+        for job in jobs:
+            task = asyncio.create_task(self._execute_in_flight(job))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
 
-        return None
+        return jobs
 
-    @write_transaction
-    async def _pull_and_execute(self) -> Optional[Job]:
-        job: Optional[Job] = None
+    async def _execute_in_flight(self, job: Job) -> None:
+        # each job in flight gets a request context of its own, so their DB connections don't get mixed up
+        async with self.app.test_request_context("/job_worker"):
+            setattr(request, "index", f"{self.worker_id}:{job.id}")
 
+            try:
+                await self._execute(job)
+                await self._release([job])
+            except Exception as ex:
+                self.logger.exception(str(ex))
+
+    async def _claim(self, limit: int) -> list[Job]:
+        jobs: list[Job] = []
+
+        started = time.perf_counter()
         try:
-            job = await jobq.service.job_db.get_one_ripe_job()
+            jobs = await jobq.service.job_db.claim_ripe_jobs(
+                limit, self.lease_owner, self.lease_seconds, self.min_priority, self.queue
+            )
         except Exception as ex:
             self.logger.error("Failed to pull a job from queue")
             self.logger.exception(str(ex))
+        metrics.claim_seconds.observe(time.perf_counter() - started, self.queue)
+
+        if not jobs:
+            metrics.empty_polls.inc(self.queue)
+            self._empty_polls += 1
+            # once when the worker runs dry, then every so often while it stays that way
+            if (self._empty_polls - 1) % self.sound_off_every_cycles == 0:
+                self.logger.info(f"No ripe jobs for worker :( ({self._empty_polls} empty polls in a row)")
+            return jobs
+
+        self._empty_polls = 0
+        if len(jobs) > 1:
+            self.logger.info(f"Pulled a batch of {len(jobs)} jobs")
+
+        return jobs
+
+    async def _release(self, jobs: list[Job]) -> None:
+        done: list[Job] = []
+        retries: list[Job] = []
+
+        for job in jobs:
+            if self._set_up_retry(job):
+                retries.append(job)
+                metrics.retries.inc(job.job_type)
+            else:
+                done.append(job)
+                if not job.completed:
+                    metrics.dead_letters.inc(job.job_type)
 
-        if not job:
-            self.logger.info("No ripe jobs for worker :(")
-            return None
+        try:
+            await jobq.service.job_db.release_jobs(done, retries, self.lease_owner)
+        except Exception as ex:
+            self.logger.error("Failed to release jobs, they will be retried when their lease runs out")
+            self.logger.exception(str(ex))
 
+    async def _execute(self, job: Job) -> None:
         self.logger.info(f"We have a JOB TO DO of type [{job.job_type}]")
+        started = time.monotonic()
 
         try:
             await jobq.service.job_execution.execute(job)
             job.completed = True
             self.logger.info("Job succeeded")
         except Exception as ex:
+            job.error = f"{ex.__class__.__name__}: {ex}"
             self.logger.warn("Job did not succeed")
             self.logger.exception(str(ex))
+        finally:
+            duration = time.monotonic() - started
+            job.duration_ms = int(duration * 1000)
+            metrics.job_seconds.observe(duration, job.job_type)
+            metrics.jobs.inc(job.job_type, "completed" if job.completed else "failed")
 
-        # if the job did not succeed, reschedule a retry if any, and bail
-        try:
-            if not job.completed:
-                job.tries = job.tries + 1
-                if job.tries < job.max_retries + 1:
-                    self.logger.info(f"Scheduling retry {job.tries + 1}")
-                    job.update_for_next_retry()
-                    await jobq.service.job_db.save(job)
-        except Exception as ex:
-            self.logger.exception(str(ex))
+    # if the job did not succeed, set it up for a retry if it has any left
+    def _set_up_retry(self, job: Job) -> bool:
+        if job.completed:
+            return False
+
+        job.tries = job.tries + 1
+        if job.tries < job.max_retries + 1:
+            self.logger.info(f"Scheduling retry {job.tries + 1}")
+            job.update_for_next_retry()
+            return True
 
-        return job
+        return False
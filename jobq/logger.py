@@ -1,10 +1,25 @@
 import logging
+import os
+import queue
 import sys
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
 
 from siftlog import ColorPlainTextStreamHandler, SiftLog  # type: ignore
 
 from jobq.constants import Const
 
+
+class JobqLog(SiftLog):
+    """
+    SiftLog without the caller location. Looking it up walks the whole stack with inspect on every log call,
+    which costs more than everything else the call does put together.
+    """
+
+    def get_caller_info(self):
+        return None
+
+
 core_logger = logging.getLogger(Const.LOG_NAME)
 core_logger.setLevel(10)
 
@@ -14,6 +29,46 @@ color_handler.set_color(SiftLog.TRACE, fg=color_handler.BLACK, bg=color_handler.
 color_handler.set_color(logging.DEBUG, fg=color_handler.CYAN)
 core_logger.addHandler(color_handler)
 
-logger = SiftLog(
+logger = JobqLog(
     core_logger,
 )
+
+# writes the queued log lines, on a thread of its own
+log_listener: Optional[QueueListener] = None
+
+
+def configure_logging() -> None:
+    core_logger.setLevel(os.environ.get(Const.Config.LOG_LEVEL, "DEBUG").upper())
+
+    if int(os.environ.get(Const.Config.LOG_QUEUE, 0)):
+        start_log_queue()
+
+
+def start_log_queue() -> None:
+    """
+    Hand log lines to a thread that writes them out, so a slow stdout never blocks the event loop
+    """
+    global log_listener
+    if log_listener:
+        return
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    core_logger.removeHandler(color_handler)
+    core_logger.addHandler(QueueHandler(log_queue))
+
+    log_listener = QueueListener(log_queue, color_handler, respect_handler_level=True)
+    log_listener.start()
+
+
+def stop_log_queue() -> None:
+    # writes out what is still queued
+    global log_listener
+    if not log_listener:
+        return
+
+    log_listener.stop()
+    log_listener = None
+
+    for handler in [h for h in core_logger.handlers if isinstance(h, QueueHandler)]:
+        core_logger.removeHandler(handler)
+    core_logger.addHandler(color_handler)
@@ -0,0 +1,131 @@
+"""
+In-process metrics, served in the Prometheus text format on /metrics.
+
+Metrics are only ever updated on the event loop thread (jobs in thread and process pools are timed from the loop),
+so an update is a plain dict operation, with no locks. Each process has its own numbers.
+"""
+import bisect
+import time
+from typing import Optional
+
+# seconds - from a fast claim to a slow job
+DEFAULT_BUCKETS: tuple[float, ...] = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+def escape(value: object) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metric:
+    kind: str
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+
+    def label_text(self, values: tuple, extra: str = "") -> str:
+        pairs: list[str] = [f'{label}="{escape(value)}"' for label, value in zip(self.labels, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        return "\n".join([f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}", *self.samples()])
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, description, labels)
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, *label_values: object, amount: float = 1) -> None:
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self) -> list[str]:
+        return [f"{self.name}{self.label_text(key)} {value}" for key, value in self.values.items()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, *label_values: object) -> None:
+        self.values[label_values] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, description: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS
+    ):
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+        # label values -> [count per bucket..., count above the last bucket, sum]
+        self.values: dict[tuple, list[float]] = {}
+
+    def observe(self, value: float, *label_values: object) -> None:
+        counts: Optional[list[float]] = self.values.get(label_values)
+        if counts is None:
+            counts = self.values[label_values] = [0] * (len(self.buckets) + 2)
+
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self) -> list[str]:
+        lines: list[str] = []
+
+        for key, counts in self.values.items():
+            # buckets are cumulative on the way out
+            total = 0.0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                total += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{self.label_text(key, le)} {total}")
+
+            lines.append(f"{self.name}_sum{self.label_text(key)} {counts[-1]}")
+            lines.append(f"{self.name}_count{self.label_text(key)} {total}")
+
+        return lines
+
+
+class Metrics:
+    # queue depth takes a DB query, so it is sampled at most this often, however often the metrics are scraped
+    sample_seconds: float = 10
+    sampled_at: Optional[float] = None
+
+    def __init__(self):
+        self.claim_seconds = Histogram("jobq_claim_seconds", "Time to claim a batch of ripe jobs", ("queue",))
+        self.empty_polls = Counter("jobq_empty_polls_total", "Claims that found no ripe jobs", ("queue",))
+        self.job_seconds = Histogram("jobq_job_seconds", "Time to run a job", ("job_type",))
+        self.jobs = Counter("jobq_jobs_total", "Jobs run, by how they went", ("job_type", "outcome"))
+        self.retries = Counter("jobq_retries_total", "Failed jobs scheduled for another try", ("job_type",))
+        self.dead_letters = Counter("jobq_dead_letters_total", "Jobs that ran out of retries", ("job_type",))
+        self.expired_leases = Counter(
+            "jobq_expired_leases_total", "Jobs of crashed or hung workers, requeued or dead", ("outcome",)
+        )
+        self.pool_acquire_seconds = Histogram(
+            "jobq_pool_acquire_seconds", "Time waiting for a pooled DB connection", buckets=DEFAULT_BUCKETS[:10]
+        )
+        self.pool_connections = Gauge("jobq_pool_connections", "Pooled DB connections, in use or idle", ("state",))
+        self.queued_jobs = Gauge("jobq_queued_jobs", "Jobs in the job table, estimated for big tables", ("state",))
+        self.oldest_ripe_job_seconds = Gauge(
+            "jobq_oldest_ripe_job_seconds", "How long the oldest ripe job (of those next in line) has been waiting"
+        )
+
+    def all(self) -> list[Metric]:
+        return [metric for metric in vars(self).values() if isinstance(metric, Metric)]
+
+    def sample_is_stale(self) -> bool:
+        return self.sampled_at is None or time.monotonic() - self.sampled_at > self.sample_seconds
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.all()) + "\n"
+
+
+metrics = Metrics()
@@ -1,7 +1,6 @@
 import datetime
 from enum import Enum
-from json import loads
-from typing import Optional, Type
+from typing import ClassVar, Optional, Type
 
 from pydantic import BaseModel, ConfigDict
 
@@ -13,6 +12,15 @@ class JobType(Enum):
     JOB_TYPE_2 = "JOB_TYPE_2"
 
 
+class JobState(Enum):
+    # waiting for a worker, ripe or not
+    QUEUED = "queued"
+    RIPE = "ripe"
+    SCHEDULED = "scheduled"
+    # leased to a worker
+    RUNNING = "running"
+
+
 class Job(BaseModel):
     id: Optional[str] = None
     job_type: JobType
@@ -21,8 +29,34 @@ class Job(BaseModel):
     # minutes before first retry, then exponentially backing off - 5, 20, 45 ...
     base_retry_minutes: int = Const.Jobs.BASE_RETRY_MINUTES
     ripe_at: Optional[datetime.datetime] = None
+    # the higher, the sooner it runs
+    priority: int = 0
+    queue: str = Const.Jobs.DEFAULT_QUEUE
     arguments: dict[str, int | str | bool] = {}
+    leased_until: Optional[datetime.datetime] = None
+    worker_id: Optional[str] = None
+    # jobs with the same key are the same job, whatever their arguments
+    idempotency_key: Optional[str] = None
     completed: bool = False
+    # how the last try went - archived with the job when it's done, not stored in the job table
+    error: Optional[str] = None
+    duration_ms: Optional[int] = None
+
+    # the fields that are stored in the job table
+    DB_FIELDS: ClassVar[tuple[str, ...]] = (
+        "id",
+        "job_type",
+        "tries",
+        "max_retries",
+        "base_retry_minutes",
+        "ripe_at",
+        "priority",
+        "queue",
+        "arguments",
+        "leased_until",
+        "worker_id",
+        "idempotency_key",
+    )
 
     model_config = ConfigDict(
         populate_by_name=True,  # to allow value assignment by snake AND camelCase
@@ -31,16 +65,44 @@ class Job(BaseModel):
 
     @classmethod
     # Convert raw SQL output into a Job object.
-    # Since "arguments" is of type JSONB, it requires special treatment
+    # The row comes from our own table, already typed by the driver (JSONB "arguments" are decoded by the connection
+    # codec), so it is trusted and skips validation - this runs for every row on the claim path.
     def from_db(cls: Type["Job"], db_data: dict) -> "Job":
-        db_data["arguments"] = loads(db_data["arguments"])
-        return Job.model_validate(db_data)
+        # immediate jobs are stored as ripe at -infinity, which comes back as datetime.min
+        if db_data["ripe_at"] == datetime.datetime.min:
+            db_data["ripe_at"] = None
+
+        values = {field: db_data[field] for field in cls.DB_FIELDS}
+        values.update(completed=False, error=None, duration_ms=None)
+
+        # what model_construct() does, minus its per-field default handling, which makes it slower than validation
+        job = cls.__new__(cls)
+        object.__setattr__(job, "__dict__", values)
+        object.__setattr__(job, "__pydantic_fields_set__", set(cls.DB_FIELDS))
+        object.__setattr__(job, "__pydantic_extra__", None)
+        object.__setattr__(job, "__pydantic_private__", None)
+        return job
 
     # mutate the current object, setting the time for the next retry
     def update_for_next_retry(self) -> None:
         next_retry_minutes = self.base_retry_minutes * pow(self.tries, 2)
         self.ripe_at = datetime.datetime.now() + datetime.timedelta(minutes=next_retry_minutes)
 
+    # how long until the job is ripe, zero for immediate and overdue jobs
+    def seconds_until_ripe(self) -> float:
+        if not self.ripe_at:
+            return 0
+
+        # DB rows come back timezone-aware, jobs created in code are naive local time
+        now = datetime.datetime.now(self.ripe_at.tzinfo)
+        return max((self.ripe_at - now).total_seconds(), 0)
+
+    def state(self) -> JobState:
+        if self.leased_until:
+            return JobState.RUNNING
+
+        return JobState.SCHEDULED if self.seconds_until_ripe() else JobState.RIPE
+
     # mutate the current object, setting when the job will run first
     def runs_in(self, minutes: int = 0, hours: int = 0) -> "Job":
         if self.ripe_at:
@@ -55,7 +117,7 @@ class Job(BaseModel):
     def __str__(self):
         return (
             f"Job: {self.id}. Type: {self.job_type}. "
-            f"Ripe at {self.ripe_at}. "
+            f"Queue: {self.queue}. Ripe at {self.ripe_at}. Priority: {self.priority}. "
             f"Tries: {self.max_retries}, starting in {self.base_retry_minutes} minutes. "
             f"Arguments: {self.arguments}"
         )
@@ -0,0 +1,102 @@
+-- The job table split into time buckets by ripe_at (PARTITIONED = 1). Use instead of schema.sql.
+--
+-- Under heavy churn, a single job table bloats and keeps autovacuum busy. Here, new jobs go into the current bucket
+-- (immediate jobs are ripe right away, not at -infinity), the claim only looks at buckets that are already ripe,
+-- and once an old bucket has drained, it's dropped as a whole instead of being vacuumed row by row.
+-- Buckets are created ahead of time and dropped by JobDbService.maintain_partitions().
+
+DROP SCHEMA public CASCADE;
+CREATE SCHEMA public;
+
+CREATE TABLE job(
+    id UUID NOT NULL DEFAULT gen_random_uuid(),
+    job_type TEXT NOT NULL,
+    arguments JSONB NOT NULL DEFAULT '{}'::JSONB,
+    -- set by the producer, to make a retried submission the same job. Otherwise it's the same job type and arguments
+    idempotency_key TEXT DEFAULT NULL,
+    unique_signature VARCHAR GENERATED ALWAYS AS (
+        md5(COALESCE('key:' || idempotency_key, job_type || arguments::text))
+    ) STORED,
+    -- how many tries it has been
+    tries INT NOT NULL DEFAULT 0,
+    -- how many tries it can be
+    max_retries INT NOT NULL,
+    base_retry_minutes INT NOT NULL,
+    -- the higher, the sooner. Among ripe jobs of the same priority, the one ripe the longest goes first
+    priority INT NOT NULL DEFAULT 0,
+    -- each queue has its own workers, so a family of slow jobs can't hog all of them
+    queue TEXT NOT NULL DEFAULT 'default',
+    -- the partition key. A retry moves the job to a later bucket
+    ripe_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    -- a claimed job stays in the table, leased to a worker until it is done. If the lease runs out,
+    -- the worker is presumed dead and the job goes back in the queue
+    leased_until TIMESTAMPTZ DEFAULT NULL,
+    worker_id TEXT DEFAULT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    updated_at TIMESTAMPTZ DEFAULT NULL,
+    -- unique keys of a partitioned table have to include the partition key
+    PRIMARY KEY (id, ripe_at)
+) PARTITION BY RANGE (ripe_at);
+
+-- jobs beyond the buckets created so far. They are moved to their bucket when it is created
+CREATE TABLE job_default PARTITION OF job DEFAULT;
+
+CREATE INDEX job_claim_idx ON job(queue, priority DESC, ripe_at, id) WHERE leased_until IS NULL;
+CREATE INDEX job_ripe_idx ON job(ripe_at, id) WHERE leased_until IS NULL;
+CREATE INDEX job_leased_until_idx ON job(leased_until) WHERE leased_until IS NOT NULL;
+-- Not unique, as the signature can't be unique across partitions.
+-- Saving jobs takes an advisory lock on their signatures instead (see JobDbService.save_many)
+CREATE INDEX job_unique_signature_idx ON job(unique_signature);
+
+-- Jobs that are done: completed, or dead after running out of retries.
+-- Append-only - written when a job leaves the job table, pruned by JobDbService.prune_history()
+CREATE TABLE job_history(
+    id UUID NOT NULL,
+    job_type TEXT NOT NULL,
+    arguments JSONB NOT NULL,
+    queue TEXT NOT NULL,
+    priority INT NOT NULL,
+    max_retries INT NOT NULL,
+    base_retry_minutes INT NOT NULL,
+    -- how many tries it took, the last one included
+    tries INT NOT NULL,
+    -- completed or dead
+    status TEXT NOT NULL,
+    -- why the last try failed
+    error TEXT,
+    -- how long the last try took
+    duration_ms INT,
+    worker_id TEXT,
+    created_at TIMESTAMPTZ NOT NULL,
+    finished_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+-- rows come in finished_at order, so a tiny BRIN index is all the retention needs
+CREATE INDEX job_history_finished_at_idx ON job_history USING BRIN(finished_at);
+CREATE INDEX job_history_dead_idx ON job_history(id) WHERE status = 'dead';
+
+-- what is left of the history after retention: hourly counts
+CREATE TABLE job_history_rollup(
+    hour TIMESTAMPTZ NOT NULL,
+    job_type TEXT NOT NULL,
+    queue TEXT NOT NULL,
+    status TEXT NOT NULL,
+    jobs INT NOT NULL,
+    duration_ms BIGINT NOT NULL,
+    PRIMARY KEY (hour, job_type, queue, status)
+);
+
+--- function and trigger to update a job's updated_at timestamp whenever there is save event
+
+CREATE OR REPLACE FUNCTION update_changed_at()
+    RETURNS TRIGGER AS $$
+BEGIN
+    NEW.updated_at = now();
+RETURN NEW;
+END;
+$$ language 'plpgsql';
+
+
+CREATE TRIGGER trigger_rec_updated_job
+    BEFORE INSERT OR UPDATE ON job
+    FOR EACH ROW EXECUTE PROCEDURE update_changed_at();
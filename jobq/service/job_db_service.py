@@ -1,35 +1,215 @@
 import datetime
+import functools
 import json
+import logging
+import os
 import re
 from typing import Optional
 
 from asyncpg import Connection  # type: ignore
 from quart import has_request_context, request
 
+from jobq.constants import Const
 from jobq.db import db
 from jobq.logger import logger
-from jobq.models.job import Job
+from jobq.models.job import Job, JobState
 from jobq.transaction import read_transaction, write_transaction
 
+SPACES = re.compile(" +")
+
 
 class JobDbService:
     """
     Data access layer for raw Squeel
     """
 
+    # Ripe jobs are taken most urgent first, then in the order they became ripe, off the partial claim index.
+    # A worker only looks at its queue's part of the index, and with a priority floor, only at the part above it.
+    # If partitioned, matching on ripe_at as well keeps the update away from partitions that aren't ripe yet.
+    # The claimed rows are MATERIALIZED - as a plain IN (...) subquery the planner is free to run it more than once,
+    # and the LIMIT would no longer hold.
+    CLAIM_RIPE_JOBS = """
+              WITH claimed AS MATERIALIZED (
+                   SELECT id, ripe_at FROM job
+                    WHERE leased_until IS NULL AND queue = $6 AND ripe_at <= $1
+                      AND priority >= COALESCE($5::int, -2147483648)
+                 ORDER BY priority DESC, ripe_at
+               FOR UPDATE
+              SKIP LOCKED LIMIT $2
+              )
+            UPDATE job
+               SET leased_until = $1::timestamptz + make_interval(secs => $3), worker_id = $4
+              FROM claimed
+             WHERE job.id = claimed.id AND job.ripe_at = claimed.ripe_at AND job.ripe_at <= $1
+         RETURNING job.*, job.id::text
+            """
+
+    # Saving jobs: the input rows, with the signature they are de-duplicated on, then merged into the table ("saved"),
+    # then every input row is matched back to its saved row by signature
+    SAVE_INPUT = """
+              WITH input AS (
+                   SELECT *, md5(COALESCE('key:' || idempotency_key, job_type || arguments::text)) AS unique_signature
+                     FROM unnest(
+                              $1::text[], $2::jsonb[], $3::timestamptz[], $4::int[], $5::int[], $6::int[], $7::int[],
+                              $8::text[], $9::text[]
+                          ) WITH ORDINALITY
+                          AS input(
+                              job_type, arguments, ripe_at, tries, max_retries, base_retry_minutes, priority, queue,
+                              idempotency_key, ord
+                          )
+              ),
+              notified AS (
+                   SELECT count(pg_notify($10, payload)) FROM unnest($11::text[]) AS payload
+              ),
+              %s
+            SELECT saved.id::text
+              FROM input
+              JOIN saved USING (unique_signature)
+             CROSS JOIN notified
+          ORDER BY input.ord
+            """
+
+    # Duplicates within the batch are merged before the insert, as ON CONFLICT cannot touch the same row twice
+    SAVE_JOBS = (
+        SAVE_INPUT
+        % """
+              saved AS (
+                   INSERT INTO job (
+                          job_type, arguments, ripe_at, tries, max_retries, base_retry_minutes, priority, queue,
+                          idempotency_key
+                   )
+                        SELECT DISTINCT ON (unique_signature)
+                               job_type, arguments, COALESCE(ripe_at, '-infinity'), tries, max_retries,
+                               base_retry_minutes, priority, queue, idempotency_key
+                          FROM input
+                      ORDER BY unique_signature, priority DESC, ord
+                   ON CONFLICT (unique_signature)
+                 DO UPDATE SET priority = GREATEST(job.priority, EXCLUDED.priority)
+                     RETURNING id, unique_signature
+              )"""
+    )
+
+    # With the signatures locked, jobs that are already queued are updated, and the rest inserted.
+    # Immediate jobs are ripe now, so they land in the current partition.
+    SAVE_JOBS_PARTITIONED = (
+        SAVE_INPUT
+        % """
+              existing AS (
+                   UPDATE job
+                      SET priority = GREATEST(job.priority, input.priority)
+                     FROM (
+                          SELECT unique_signature, max(priority) AS priority FROM input GROUP BY unique_signature
+                          ) AS input
+                    WHERE job.unique_signature = input.unique_signature
+                RETURNING job.id, job.unique_signature
+              ),
+              inserted AS (
+                   INSERT INTO job (
+                          job_type, arguments, ripe_at, tries, max_retries, base_retry_minutes, priority, queue,
+                          idempotency_key
+                   )
+                        SELECT DISTINCT ON (unique_signature)
+                               job_type, arguments, COALESCE(ripe_at, now()), tries, max_retries,
+                               base_retry_minutes, priority, queue, idempotency_key
+                          FROM input
+                         WHERE NOT EXISTS (SELECT FROM job WHERE job.unique_signature = input.unique_signature)
+                      ORDER BY unique_signature, priority DESC, ord
+                     RETURNING id, unique_signature
+              ),
+              saved AS (
+                   SELECT id, unique_signature FROM existing
+                    UNION ALL
+                   SELECT id, unique_signature FROM inserted
+              )"""
+    )
+
+    # Jobs leaving the job table for good are archived - "finished" are the deleted rows, with their outcome
+    ARCHIVE_FINISHED = """
+                   INSERT INTO job_history (
+                          id, job_type, arguments, queue, priority, max_retries, base_retry_minutes, tries,
+                          status, error, duration_ms, worker_id, created_at
+                   )
+                   SELECT id, job_type, arguments, queue, priority, max_retries, base_retry_minutes, tries + 1,
+                          CASE WHEN completed THEN 'completed' ELSE 'dead' END, error, duration_ms, worker_id,
+                          created_at
+                     FROM finished
+            """
+
+    # Leased jobs given back: the done ones are moved to the history, the rest rescheduled
+    RELEASE_JOBS = f"""
+              WITH finished AS (
+                   DELETE FROM job
+                    USING unnest($2::uuid[], $3::bool[], $4::text[], $5::int[])
+                          AS done(id, completed, error, duration_ms)
+                    WHERE job.id = done.id AND job.worker_id IS NOT DISTINCT FROM $1
+                RETURNING job.*, done.completed, done.error, done.duration_ms
+              ),
+              archived AS (
+                   {ARCHIVE_FINISHED}
+              ),
+              retried AS (
+                   UPDATE job
+                      SET tries = retry.tries, ripe_at = retry.ripe_at, leased_until = NULL, worker_id = NULL
+                     FROM unnest($6::uuid[], $7::int[], $8::timestamptz[]) AS retry(id, tries, ripe_at)
+                    WHERE job.id = retry.id AND job.worker_id IS NOT DISTINCT FROM $1
+              )
+            SELECT count(pg_notify($9, payload)) FROM unnest($10::text[]) AS payload
+            """
+
+    # the job table is split into ripe_at buckets (see schema_partitioned.sql)
+    partitioned: bool = False
+    # how many hours a partition covers
+    partition_hours: int = 1
+    # how many partitions to keep ready beyond the current one
+    partitions_ahead: int = 24
+
+    # how long completed and dead jobs are kept in the history before they are rolled up into hourly counts
+    history_days: float = 7
+    dead_letter_days: float = 30
+    # history rows pruned per transaction
+    history_batch_size: int = 10000
+    # above this many jobs (as estimated by the planner statistics), the dashboard doesn't count them exactly
+    exact_count_limit: int = 100000
+
+    def configure(self) -> None:
+        """
+        Read the settings, and register the statements on the claim path to be prepared on every pooled connection
+        """
+        self.partitioned = bool(int(os.environ.get(Const.Config.PARTITIONED, 0)))
+        self.partition_hours = int(os.environ.get(Const.Config.PARTITION_HOURS, 1))
+        self.history_days = float(os.environ.get(Const.Config.HISTORY_DAYS, 7))
+        self.dead_letter_days = float(os.environ.get(Const.Config.DEAD_LETTER_DAYS, 30))
+
+        db.connection_manager.register_statement("jobq_claim", self.CLAIM_RIPE_JOBS)
+        db.connection_manager.register_statement(
+            "jobq_save", self.SAVE_JOBS_PARTITIONED if self.partitioned else self.SAVE_JOBS
+        )
+        db.connection_manager.register_statement("jobq_release", self.RELEASE_JOBS)
+
     @staticmethod
-    async def execute_with_result(stmt: str, *args) -> Optional[dict]:
-        conn: Connection = db.connection_manager.get_connection()
-        log_stmt = re.sub(" +", " ", stmt.replace("\n", "")[0:80])
+    @functools.lru_cache(maxsize=256)
+    def statement_label(stmt: str) -> str:
+        # the same few statements run over and over, so they are only squeezed into a log line once
+        return SPACES.sub(" ", stmt.replace("\n", "")[0:80])
+
+    @classmethod
+    def log_statement(cls, stmt: str) -> None:
+        if not logger.isEnabledFor(logging.INFO):
+            return
 
         if has_request_context():
             worker_id = getattr(request, "index", 0)
-            logger.info(f"Worker #{worker_id} executing [{log_stmt}...]")
+            logger.info(f"Worker #{worker_id} executing [{cls.statement_label(stmt)}...]")
         else:
             # not executed in a worker
-            logger.info(f"Executing [{log_stmt}...]")
+            logger.info(f"Executing [{cls.statement_label(stmt)}...]")
+
+    @classmethod
+    async def execute_with_result(cls, stmt: str, *args) -> Optional[dict]:
+        conn: Connection = db.connection_manager.get_connection()
+        cls.log_statement(stmt)
 
-        results = await conn.fetch(stmt, *args)
+        results = await cls.fetch(conn, stmt, *args)
 
         if not results:
             return None
@@ -38,67 +218,605 @@ class JobDbService:
         result: dict = results[0]
         return dict(result)
 
-    @staticmethod
-    async def execute_with_results(stmt, *args) -> list[dict]:
+    @classmethod
+    async def execute_with_results(cls, stmt: str, *args) -> list[dict]:
         conn: Connection = db.connection_manager.get_connection()
-        log_stmt = re.sub(" +", " ", stmt.replace("\n", "")[0:80])
-
-        if has_request_context():
-            worker_id = getattr(request, "index", 0)
-            logger.info(f"Worker #{worker_id} executing [{log_stmt}...]")
-        else:
-            # not executed in a worker
-            logger.info(f"Executing [{log_stmt}...]")
+        cls.log_statement(stmt)
 
-        results = await conn.fetch(stmt, *args)
+        results = await cls.fetch(conn, stmt, *args)
         return [dict(x) for x in results]
 
+    @staticmethod
+    async def fetch(conn: Connection, stmt: str, *args) -> list:
+        # the hot statements are prepared on pooled connections (a pool proxy passes the attribute through)
+        prepared = getattr(conn, "prepared", None)
+        statement = prepared.get(stmt) if prepared else None
+
+        if statement:
+            return await statement.fetch(*args)
+
+        return await conn.fetch(stmt, *args)
+
+    @staticmethod
+    def notifications(jobs: list[Job]) -> list[str]:
+        """
+        NOTIFY payloads for saved jobs, one per queue: the seconds until the first one is ripe, and the highest priority
+        """
+        by_queue: dict[str, list[Job]] = {}
+        for job in jobs:
+            by_queue.setdefault(job.queue, []).append(job)
+
+        return [
+            json.dumps(
+                {
+                    "queue": queue,
+                    "delay": min(job.seconds_until_ripe() for job in queue_jobs),
+                    "priority": max(job.priority for job in queue_jobs),
+                }
+            )
+            for queue, queue_jobs in by_queue.items()
+        ]
+
     @write_transaction
     async def save(self, obj: Job) -> Job:
-        res = await self.execute_with_result(
-            """
-           INSERT INTO job (job_type, arguments, ripe_at, tries, max_retries, base_retry_minutes)
-                VALUES ($1, $2, $3, $4, $5, $6)
-           ON CONFLICT (unique_signature)
-         DO UPDATE SET job_type = $1
-             RETURNING id::text
-            """,
-            obj.job_type,
-            json.dumps(obj.arguments),
-            obj.ripe_at,
-            obj.tries,
-            obj.max_retries,
-            obj.base_retry_minutes,
-        )
-        assert res
+        ids: list[str] = await self.save_many([obj])
 
         job: Job = Job.model_validate(obj)
-        job.id = res["id"]
+        job.id = ids[0]
 
         logger.info(f"Job SCHEDULED. {job}")
 
         return job
 
     @write_transaction
-    async def get_one_ripe_job(self) -> Optional[Job]:
+    async def save_many(self, jobs: list[Job]) -> list[str]:
+        """
+        Enqueue a batch of jobs in a single statement, returning their IDs in the same order.
+        A job that is already queued (same idempotency key, or without one, same type and arguments) is not
+        duplicated - its existing ID is returned, and if the new one has a higher priority, the queued job is bumped up.
+        Listening workers get a NOTIFY on commit.
+        """
+        if not jobs:
+            return []
+
+        if self.partitioned:
+            # No unique index to conflict on - jobs with the same signature are saved one transaction at a time,
+            # so the statement below (with a fresh snapshot) sees any that were saved before
+            await self.execute_with_result(
+                """
+                SELECT count(pg_advisory_xact_lock(hashtextextended(unique_signature, 0)))
+                  FROM (
+                       SELECT DISTINCT md5(COALESCE('key:' || idempotency_key, job_type || arguments::text))
+                              AS unique_signature
+                         FROM unnest($1::text[], $2::jsonb[], $3::text[]) AS input(job_type, arguments, idempotency_key)
+                     ORDER BY unique_signature
+                  ) AS signatures
+                """,
+                [job.job_type for job in jobs],
+                [job.arguments for job in jobs],
+                [job.idempotency_key for job in jobs],
+            )
+
+        results = await self.execute_with_results(
+            self.SAVE_JOBS_PARTITIONED if self.partitioned else self.SAVE_JOBS,
+            [job.job_type for job in jobs],
+            [job.arguments for job in jobs],
+            [job.ripe_at for job in jobs],
+            [job.tries for job in jobs],
+            [job.max_retries for job in jobs],
+            [job.base_retry_minutes for job in jobs],
+            [job.priority for job in jobs],
+            [job.queue for job in jobs],
+            [job.idempotency_key for job in jobs],
+            Const.Jobs.NOTIFY_CHANNEL,
+            self.notifications(jobs),
+        )
+
+        logger.info(f"{len(jobs)} jobs SCHEDULED")
+
+        return [result["id"] for result in results]
+
+    async def get_one_ripe_job(
+        self,
+        worker_id: Optional[str] = None,
+        lease_seconds: int = Const.Jobs.LEASE_SECONDS,
+        min_priority: Optional[int] = None,
+        queue: str = Const.Jobs.DEFAULT_QUEUE,
+    ) -> Optional[Job]:
+        jobs: list[Job] = await self.claim_ripe_jobs(1, worker_id, lease_seconds, min_priority, queue)
+        return jobs[0] if jobs else None
+
+    @write_transaction
+    async def claim_ripe_jobs(
+        self,
+        limit: int,
+        worker_id: Optional[str] = None,
+        lease_seconds: int = Const.Jobs.LEASE_SECONDS,
+        min_priority: Optional[int] = None,
+        queue: str = Const.Jobs.DEFAULT_QUEUE,
+    ) -> list[Job]:
+        """
+        Lease up to `limit` ripe jobs from a queue to a worker in one round trip, most urgent first.
+        With `min_priority`, jobs below it are left to other workers.
+        Rows locked by other workers are skipped, so concurrent workers never claim the same job.
+        The transaction is over as soon as the jobs are leased - they are executed without holding on to it.
+        """
+        results = await self.execute_with_results(
+            self.CLAIM_RIPE_JOBS,
+            datetime.datetime.now(),
+            limit,
+            lease_seconds,
+            worker_id,
+            min_priority,
+            queue,
+        )
+
+        return [Job.from_db(result) for result in results]
+
+    @write_transaction
+    async def release_jobs(self, done: list[Job], retries: list[Job], worker_id: Optional[str] = None) -> None:
+        """
+        Give leased jobs back in one statement: jobs that are done (succeeded or out of retries) move from the queue
+        to the history, and the ones due for a retry are rescheduled.
+        A job is left alone if its lease ran out and it was since handed to another worker.
+        """
+        if not done and not retries:
+            return
+
+        await self.execute_with_result(
+            self.RELEASE_JOBS,
+            worker_id,
+            [job.id for job in done],
+            [job.completed for job in done],
+            [job.error for job in done],
+            [job.duration_ms for job in done],
+            [job.id for job in retries],
+            [job.tries for job in retries],
+            [job.ripe_at for job in retries],
+            Const.Jobs.NOTIFY_CHANNEL,
+            self.notifications(retries),
+        )
+
+        if retries:
+            logger.info(f"{len(retries)} jobs RESCHEDULED")
+
+    @write_transaction
+    async def requeue_expired_leases(self) -> dict:
+        """
+        Put jobs whose lease ran out (their worker crashed or hung) back in the queue.
+        This counts as a try, so a job that keeps killing its worker eventually runs out of retries, and is archived.
+        """
+        result = await self.execute_with_result(
+            f"""
+              WITH expired AS (
+                   SELECT id FROM job
+                    WHERE leased_until < $1
+               FOR UPDATE
+              SKIP LOCKED
+              ),
+              finished AS (
+                   DELETE FROM job
+                    USING expired
+                    WHERE job.id = expired.id AND job.tries >= job.max_retries
+                RETURNING job.*, false AS completed, 'Lease expired' AS error, NULL::int AS duration_ms
+              ),
+              archived AS (
+                   {self.ARCHIVE_FINISHED}
+              ),
+              requeued AS (
+                   UPDATE job
+                      SET tries = tries + 1, leased_until = NULL, worker_id = NULL
+                     FROM expired
+                    WHERE job.id = expired.id AND job.tries < job.max_retries
+                RETURNING job.id, job.priority, job.queue
+              ),
+              notified AS (
+                   SELECT pg_notify($2, json_build_object('queue', queue, 'delay', 0, 'priority', max(priority))::text)
+                     FROM requeued
+                 GROUP BY queue
+              )
+            SELECT (SELECT count(*) FROM requeued) AS requeued,
+                   (SELECT count(*) FROM finished) AS dead,
+                   (SELECT count(*) FROM notified) AS notified
+            """,
+            datetime.datetime.now(),
+            Const.Jobs.NOTIFY_CHANNEL,
+        )
+        assert result
+
+        if result["requeued"] or result["dead"]:
+            logger.warning(f"Expired leases: {result['requeued']} jobs requeued, {result['dead']} out of retries")
+
+        return result
+
+    async def prune_history(self) -> int:
+        """
+        Roll history that is past retention up into hourly counts, a batch per transaction, so the history
+        stays small and pruning it never holds locks for long
+        """
+        pruned = 0
+
+        while True:
+            batch: int = await self.prune_history_batch()
+            pruned += batch
+
+            if batch < self.history_batch_size:
+                break
+
+        if pruned:
+            logger.info(f"{pruned} jobs rolled up from history")
+
+        return pruned
+
+    @write_transaction
+    async def prune_history_batch(self) -> int:
         result = await self.execute_with_result(
             """
-            DELETE FROM job
-                  WHERE id = (
-                             SELECT id FROM job
-                              WHERE ripe_at IS NULL OR $1 >= ripe_at
-                         FOR UPDATE
-                        SKIP LOCKED LIMIT 1
-                  )
-              RETURNING *, id::text
+              WITH cutoff AS (
+                   SELECT now() - make_interval(secs => $1 * 86400) AS history,
+                          now() - make_interval(secs => $2 * 86400) AS dead_letters
+              ),
+              expired AS (
+                   DELETE FROM job_history
+                    WHERE ctid = ANY(ARRAY(
+                          SELECT ctid FROM job_history, cutoff
+                           WHERE finished_at < GREATEST(cutoff.history, cutoff.dead_letters)
+                             AND finished_at < CASE status WHEN 'dead' THEN cutoff.dead_letters ELSE cutoff.history END
+                           LIMIT $3
+                          ))
+                RETURNING *
+              ),
+              rolled_up AS (
+                   INSERT INTO job_history_rollup AS rollup (hour, job_type, queue, status, jobs, duration_ms)
+                        SELECT date_trunc('hour', finished_at), job_type, queue, status, count(*),
+                               COALESCE(sum(duration_ms), 0)
+                          FROM expired
+                      GROUP BY 1, 2, 3, 4
+                   ON CONFLICT (hour, job_type, queue, status)
+                 DO UPDATE SET jobs = rollup.jobs + EXCLUDED.jobs,
+                               duration_ms = rollup.duration_ms + EXCLUDED.duration_ms
+              )
+            SELECT count(*) AS pruned FROM expired
             """,
+            self.history_days,
+            self.dead_letter_days,
+            self.history_batch_size,
+        )
+
+        assert result
+        return result["pruned"]
+
+    @read_transaction
+    async def get_dead_letters(self, limit: int = 100) -> list[dict]:
+        """
+        Jobs that ran out of retries, the most recent first
+        """
+        return await self.execute_with_results(
+            """
+              SELECT id::text, job_type, arguments, queue, priority, tries, error, worker_id, created_at, finished_at
+                FROM job_history
+               WHERE status = 'dead'
+            ORDER BY finished_at DESC
+               LIMIT $1
+            """,
+            limit,
+        )
+
+    @write_transaction
+    async def requeue_dead_letters(self, ids: list[str]) -> list[str]:
+        """
+        Put dead jobs back in the queue, with a fresh set of retries. They leave the history, and come back to it
+        once they are done again. Returns the IDs of the new jobs.
+        """
+        results = await self.execute_with_results(
+            """
+            DELETE FROM job_history
+             WHERE status = 'dead' AND id = ANY($1::uuid[])
+         RETURNING job_type, arguments, queue, priority, max_retries, base_retry_minutes
+            """,
+            ids,
+        )
+
+        jobs: list[Job] = [Job.model_validate(result) for result in results]
+        return await self.save_many(jobs)
+
+    async def maintain_partitions(self) -> dict:
+        """
+        Have the partitions for the next `partitions_ahead` buckets ready, and drop the past ones that have drained.
+        Every partition is created or dropped in a transaction of its own, with a short lock timeout -
+        whatever can't be done now is left for the next run.
+        """
+        assert self.partitioned
+
+        bucket = datetime.timedelta(hours=self.partition_hours)
+        epoch = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        current: datetime.datetime = epoch + (now - epoch) // bucket * bucket
+
+        partitions: list[dict] = await self.get_partitions()
+        existing: set[datetime.datetime] = {partition["lower"] for partition in partitions}
+        created, dropped = 0, 0
+
+        for lower in (current + bucket * n for n in range(0, self.partitions_ahead + 1)):
+            if lower in existing:
+                continue
+
+            try:
+                await self.create_partition(lower, lower + bucket)
+                created += 1
+            except Exception as ex:
+                logger.error(f"Could not create the job partition for {lower}")
+                logger.exception(str(ex))
+
+        for partition in partitions:
+            if partition["upper"] > current:
+                continue
+
+            try:
+                dropped += await self.drop_drained_partition(partition["name"])
+            except Exception as ex:
+                logger.error(f"Could not drop job partition {partition['name']}")
+                logger.exception(str(ex))
+
+        return {"created": created, "dropped": dropped}
+
+    @read_transaction
+    async def get_partitions(self) -> list[dict]:
+        """
+        Bucket partitions of the job table, with their bounds (the default partition is not one of them)
+        """
+        results = await self.execute_with_results(
+            """
+            SELECT c.relname AS name, pg_get_expr(c.relpartbound, c.oid) AS bound
+              FROM pg_inherits
+              JOIN pg_class c ON c.oid = pg_inherits.inhrelid
+             WHERE pg_inherits.inhparent = 'job'::regclass
+            """
+        )
+
+        partitions: list[dict] = []
+        for result in results:
+            # FOR VALUES FROM ('2024-01-01 10:00:00+00') TO ('2024-01-01 11:00:00+00')
+            bounds = re.match(r"FOR VALUES FROM \('(.+)'\) TO \('(.+)'\)", result["bound"])
+            if not bounds:
+                continue
+
+            partitions.append(
+                {
+                    "name": result["name"],
+                    "lower": datetime.datetime.fromisoformat(bounds.group(1)),
+                    "upper": datetime.datetime.fromisoformat(bounds.group(2)),
+                }
+            )
+
+        return partitions
+
+    @write_transaction
+    async def create_partition(self, lower: datetime.datetime, upper: datetime.datetime) -> str:
+        """
+        Jobs that were scheduled this far ahead before the partition existed are in the default partition,
+        and are moved over before the partition is attached.
+        """
+        name = f"job_p{lower:%Y%m%d%H}"
+        columns = "id, job_type, arguments, tries, max_retries, base_retry_minutes, priority, queue, ripe_at, "
+        columns += "leased_until, worker_id, created_at, updated_at"
+
+        await self.execute_with_result("SET LOCAL lock_timeout = '5s'")
+        await self.execute_with_result(f"CREATE TABLE {name} (LIKE job INCLUDING DEFAULTS INCLUDING GENERATED)")
+        await self.execute_with_result(
+            f"""
+              WITH moved AS (
+                   DELETE FROM job_default
+                    WHERE ripe_at >= $1 AND ripe_at < $2
+                RETURNING {columns}
+              )
+            INSERT INTO {name} ({columns}) SELECT {columns} FROM moved
+            """,
+            lower,
+            upper,
+        )
+        bounds = f"FROM ('{lower.isoformat()}') TO ('{upper.isoformat()}')"
+        await self.execute_with_result(f"ALTER TABLE job ATTACH PARTITION {name} FOR VALUES {bounds}")
+
+        logger.info(f"Created job partition {name}")
+        return name
+
+    @write_transaction
+    async def drop_drained_partition(self, name: str) -> bool:
+        """
+        Drop a partition if it has no jobs left - dropping it is what makes its dead rows go away without a vacuum.
+        Nothing can be saved into it while it's checked, but it blocks the job table for a moment.
+        """
+        await self.execute_with_result("SET LOCAL lock_timeout = '5s'")
+        await self.execute_with_result(f"LOCK TABLE ONLY job, {name} IN ACCESS EXCLUSIVE MODE")
+
+        result = await self.execute_with_result(f"SELECT EXISTS (SELECT FROM {name}) AS busy")
+        assert result
+        if result["busy"]:
+            return False
+
+        await self.execute_with_result(f"DROP TABLE {name}")
+
+        logger.info(f"Dropped drained job partition {name}")
+        return True
+
+    @read_transaction
+    async def get_next_ripe_at(self) -> Optional[datetime.datetime]:
+        result = await self.execute_with_result(
+            "SELECT min(ripe_at) AS ripe_at FROM job WHERE leased_until IS NULL AND ripe_at > $1",
             datetime.datetime.now(),
         )
 
-        if not result:
+        assert result
+        return result["ripe_at"]
+
+    @read_transaction
+    async def get_job(self, job_id: str) -> Optional[Job]:
+        result: Optional[dict] = await self.execute_with_result("SELECT *, id::text FROM job WHERE id = $1", job_id)
+        return Job.from_db(result) if result else None
+
+    @read_transaction
+    async def get_finished_job(self, job_id: str) -> Optional[dict]:
+        """
+        A job that has left the queue, from the history - the most recent run, if it was requeued as a dead letter
+        """
+        return await self.execute_with_result(
+            """
+              SELECT id::text, job_type, arguments, queue, priority, max_retries, base_retry_minutes, tries, status,
+                     error, duration_ms, worker_id, created_at, finished_at
+                FROM job_history
+               WHERE id = $1
+            ORDER BY finished_at DESC
+               LIMIT 1
+            """,
+            job_id,
+        )
+
+    @write_transaction
+    async def cancel_job(self, job_id: str) -> Optional[bool]:
+        """
+        Take a job out of the queue. Returns None if there is no such job, and False if it's running -
+        a running job can't be taken back from its worker.
+        """
+        result = await self.execute_with_result(
+            """
+              WITH target AS (
+                   SELECT id, ripe_at, leased_until FROM job WHERE id = $1 FOR UPDATE
+              ),
+              cancelled AS (
+                   DELETE FROM job
+                    USING target
+                    WHERE job.id = target.id AND job.ripe_at = target.ripe_at AND target.leased_until IS NULL
+                RETURNING job.id
+              )
+            SELECT (SELECT count(*) FROM target) AS found, (SELECT count(*) FROM cancelled) AS cancelled
+            """,
+            job_id,
+        )
+        assert result
+
+        if not result["found"]:
             return None
 
-        return Job.from_db(result)
+        if result["cancelled"]:
+            logger.info(f"Job {job_id} CANCELLED")
+
+        return bool(result["cancelled"])
+
+    @read_transaction
+    async def get_jobs_page(
+        self,
+        limit: int = 50,
+        after: Optional[str] = None,
+        state: JobState = JobState.QUEUED,
+        job_type: Optional[str] = None,
+    ) -> tuple[list[Job], Optional[str]]:
+        """
+        A page of jobs in the order they are ripe, and the cursor of the next page (None if this is the last one).
+        Pages are keyed on (ripe_at, id) rather than offset, so getting one costs the same however deep it is.
+        """
+        conditions: list[str] = {
+            JobState.QUEUED: ["leased_until IS NULL"],
+            JobState.RIPE: ["leased_until IS NULL", "ripe_at <= now()"],
+            JobState.SCHEDULED: ["leased_until IS NULL", "ripe_at > now()"],
+            # only as many as the workers can run at once, so not worth an index of their own in this order
+            JobState.RUNNING: ["leased_until IS NOT NULL"],
+        }[state]
+        args: list = [limit + 1]
+
+        if after:
+            after_ripe_at, after_id = after.rsplit(",", 1)
+            args += [after_ripe_at, after_id]
+            conditions.append(f"(ripe_at, id) > (${len(args) - 1}::text::timestamptz, ${len(args)}::uuid)")
+
+        if job_type:
+            args.append(job_type)
+            conditions.append(f"job_type = ${len(args)}")
+
+        results = await self.execute_with_results(
+            f"""
+              SELECT *, id::text, ripe_at::text AS cursor
+                FROM job
+               WHERE {" AND ".join(conditions)}
+            ORDER BY job.ripe_at, job.id
+               LIMIT $1
+            """,
+            *args,
+        )
+
+        # one more than asked for, to know if there is a next page
+        cursor: Optional[str] = None
+        if len(results) > limit:
+            results = results[:limit]
+            cursor = f"{results[-1]['cursor']},{results[-1]['id']}"
+
+        return [Job.from_db(result) for result in results], cursor
+
+    @read_transaction
+    async def get_job_counts(self) -> dict:
+        """
+        How many jobs there are in each state. Counting millions of rows is slow, so for a big table the total
+        is the planner's estimate, and only running jobs (few, and indexed) are counted exactly.
+        """
+        estimate: Optional[dict] = await self.execute_with_result(
+            """
+            SELECT COALESCE(sum(reltuples) FILTER (WHERE reltuples > 0), 0)::bigint AS jobs
+              FROM pg_class
+             WHERE oid = 'job'::regclass OR oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = 'job'::regclass)
+            """
+        )
+        assert estimate
+
+        if estimate["jobs"] <= self.exact_count_limit:
+            counts: Optional[dict] = await self.execute_with_result(
+                """
+                SELECT count(*) FILTER (WHERE leased_until IS NULL) AS queued,
+                       count(*) FILTER (WHERE leased_until IS NULL AND ripe_at <= now()) AS ripe,
+                       count(*) FILTER (WHERE leased_until IS NULL AND ripe_at > now()) AS scheduled,
+                       count(*) FILTER (WHERE leased_until IS NOT NULL) AS running
+                  FROM job
+                """
+            )
+            assert counts
+            return {**counts, "estimated": False}
+
+        running: Optional[dict] = await self.execute_with_result(
+            "SELECT count(*) AS running FROM job WHERE leased_until IS NOT NULL"
+        )
+        assert running
+
+        return {
+            "queued": max(estimate["jobs"] - running["running"], 0),
+            "ripe": None,
+            "scheduled": None,
+            "running": running["running"],
+            "estimated": True,
+        }
+
+    @read_transaction
+    async def get_oldest_ripe_job_seconds(self, sample_size: int = 1000) -> float:
+        """
+        How long the longest waiting ripe job has been waiting. Immediate jobs are all ripe at -infinity, so for them
+        it's since they were created - only the first jobs of the ripe index are looked at, to keep it cheap.
+        """
+        result = await self.execute_with_result(
+            """
+            SELECT COALESCE(EXTRACT(epoch FROM now() - min(
+                       CASE WHEN ripe_at = '-infinity' THEN created_at ELSE ripe_at END
+                   )), 0)::float AS seconds
+              FROM (
+                   SELECT ripe_at, created_at
+                     FROM job
+                    WHERE leased_until IS NULL AND ripe_at <= now()
+                 ORDER BY ripe_at, id
+                    LIMIT $1
+              ) AS next_in_line
+            """,
+            sample_size,
+        )
+
+        assert result
+        return result["seconds"]
 
     @read_transaction
     async def get_all_jobs(self) -> list[Job]:
@@ -1,18 +1,91 @@
+import asyncio
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from enum import Enum
+from typing import Optional
+
+from jobq.constants import Const
 from jobq.logger import logger
 from jobq.models.job import Job, JobType
 
 
+class ExecutorType(Enum):
+    # on the event loop, like everything else (fine for quick and async jobs)
+    INLINE = "inline"
+    # in a thread pool, for jobs that block on I/O
+    THREAD = "thread"
+    # in a process pool, for CPU-heavy jobs that would otherwise freeze the event loop
+    PROCESS = "process"
+
+
+def run_job(job: Job) -> None:
+    """
+    The code that runs the job. It lives at the module level, so it can be pickled and run in another process.
+    """
+    match job.job_type:
+        case JobType.JOB_TYPE_1.value:
+            logger.info(f"Executing code for JOB TYPE 1, job {job.id}")
+        case JobType.JOB_TYPE_2.value:
+            logger.info(f"Executing code for JOB TYPE 2, job {job.id}")
+        case _:
+            logger.error(f"Route for job type {job.job_type} not found")
+
+
 class JobExecutionService:
     """
-    A job router - connecting the job type to the actual code that runs it.
+    A job router - connecting the job type to the actual code that runs it, and where it runs.
     """
 
-    @staticmethod
-    async def execute(job: Job):
-        match job.job_type:
-            case JobType.JOB_TYPE_1.value:
-                logger.info(f"Executing code for JOB TYPE 1, job {job.id}")
-            case JobType.JOB_TYPE_2.value:
-                logger.info(f"Executing code for JOB TYPE 2, job {job.id}")
-            case _:
-                logger.error(f"Route for job type {job.job_type} not found")
+    # job type -> executor type, set with JOB_EXECUTORS="JOB_TYPE_1=thread,JOB_TYPE_2=process"
+    executors: dict[str, ExecutorType]
+    _thread_pool: Optional[ThreadPoolExecutor] = None
+    _process_pool: Optional[ProcessPoolExecutor] = None
+
+    def __init__(self):
+        self.executors = {}
+
+    def configure(self) -> None:
+        executors: str = os.environ.get(Const.Config.JOB_EXECUTORS, "")
+
+        for executor in filter(None, executors.split(",")):
+            job_type, executor_type = executor.split("=")
+            self.executors[job_type.strip()] = ExecutorType(executor_type.strip())
+
+    def executor_for(self, job_type: JobType | str) -> ExecutorType:
+        # job types of a Job are plain strings (use_enum_values), but enums are welcome too
+        job_type = job_type.value if isinstance(job_type, JobType) else job_type
+        return self.executors.get(job_type, ExecutorType.INLINE)
+
+    async def execute(self, job: Job):
+        executor_type: ExecutorType = self.executor_for(job.job_type)
+
+        if executor_type == ExecutorType.INLINE:
+            run_job(job)
+            return
+
+        # an exception raised in the pool is re-raised here, so it drives the retries just like an inline one
+        executor: Executor = self._get_pool(executor_type)
+        await asyncio.get_running_loop().run_in_executor(executor, run_job, job)
+
+    def _get_pool(self, executor_type: ExecutorType) -> Executor:
+        if executor_type == ExecutorType.THREAD:
+            if not self._thread_pool:
+                size = os.environ.get(Const.Config.THREAD_POOL_SIZE)
+                self._thread_pool = ThreadPoolExecutor(max_workers=int(size) if size else None)
+            return self._thread_pool
+
+        if not self._process_pool:
+            size = os.environ.get(Const.Config.PROCESS_POOL_SIZE)
+            self._process_pool = ProcessPoolExecutor(max_workers=int(size) if size else None)
+            logger.info("CREATED process pool...")
+        return self._process_pool
+
+    def shutdown(self) -> None:
+        if self._thread_pool:
+            self._thread_pool.shutdown(wait=True)
+            self._thread_pool = None
+
+        if self._process_pool:
+            self._process_pool.shutdown(wait=True)
+            self._process_pool = None
+            logger.warning("CLOSED process pool...")
@@ -1,11 +1,18 @@
 import asyncio
+import datetime
+import json
 import os
+from typing import Optional
 
-from quart import Quart
+from asyncpg import Connection  # type: ignore
+from quart import Quart, request
 
+import jobq.service
 from jobq.constants import Const
+from jobq.db import db
 from jobq.job_worker import JobWorker
 from jobq.logger import logger
+from jobq.metrics import metrics
 
 
 class JobWorkerService:
@@ -14,22 +21,69 @@ class JobWorkerService:
     """
 
     workers: list[JobWorker] = []
+    # how long to wait before reconnecting the listener
+    reconnect_interval: float = 5
+    # how often to look for jobs with expired leases
+    reaper_interval: float = 60
+    _stopping: Optional[asyncio.Event] = None
+    # fires when the next known scheduled job becomes ripe
+    _ripe_timer: Optional[asyncio.TimerHandle] = None
+    _ripe_timer_fired: Optional[asyncio.Event] = None
 
     def start(self, app: Quart):
-        worker_count = int(os.environ.get(Const.Config.WORKER_COUNT, 0))
+        self.reconnect_interval = float(os.environ.get(Const.Config.POLLING_INTERVAL, 5))
+        self.reaper_interval = float(os.environ.get(Const.Config.REAPER_INTERVAL, 60))
 
-        for _ in range(0, worker_count):
-            worker = JobWorker(worker_id=_ + 1, app=app)
-            app.add_background_task(worker.run)
-            self.workers.append(worker)
+        # queue -> settings of its worker group, overriding the environment:
+        # {"slow": {"WORKERS": 1, "CONCURRENCY": 4, "POLLING_INTERVAL": 30}}
+        # The default queue gets a group of its own unless it's configured explicitly.
+        worker_groups: dict[str, dict] = json.loads(os.environ.get(Const.Config.WORKER_GROUPS) or "{}")
+        worker_groups.setdefault(Const.Jobs.DEFAULT_QUEUE, {})
+
+        for queue, settings in worker_groups.items():
+            worker_count = int(settings.get(Const.Config.WORKER_COUNT, os.environ.get(Const.Config.WORKER_COUNT, 0)))
+
+            # "10,,5" - the first worker only takes jobs with priority 10 and up, the third 5 and up, the rest take all
+            priority_floors: list[str] = str(
+                settings.get(Const.Config.PRIORITY_FLOORS, os.environ.get(Const.Config.PRIORITY_FLOORS, ""))
+            ).split(",")
+
+            for _ in range(0, worker_count):
+                floor: str = priority_floors[_].strip() if _ < len(priority_floors) else ""
+                worker = JobWorker(
+                    worker_id=len(self.workers) + 1,
+                    app=app,
+                    min_priority=int(floor) if floor else None,
+                    queue=queue,
+                    settings=settings,
+                )
+                app.add_background_task(worker.run)
+                self.workers.append(worker)
+
+            logger.info(f"Queue [{queue}] has {worker_count} workers")
 
         if not self.workers:
             logger.warn("NO JOBS ARE RUNNING")
+            return
+
+        self._stopping = asyncio.Event()
+        app.add_background_task(self.reap, app)
+
+        if int(os.environ.get(Const.Config.LISTEN_NOTIFY, 0)):
+            self._ripe_timer_fired = asyncio.Event()
+            app.add_background_task(self.listen)
 
     async def stop(self):
         if not self.workers:
             return
 
+        if self._stopping:
+            self._stopping.set()
+
+        if self._ripe_timer:
+            self._ripe_timer.cancel()
+            self._ripe_timer = None
+
         for worker in self.workers:
             worker.request_stop()
 
@@ -38,3 +92,171 @@ class JobWorkerService:
             await asyncio.sleep(1)
 
         logger.info("All workers have stopped")
+
+    def wake_up_workers(self, priority: Optional[int] = None, queue: Optional[str] = None):
+        """
+        Wake up one idle worker that takes jobs of this priority from the queue (from every queue, if it's not known).
+        If they are all busy, have them pull again as soon as they are done.
+        """
+        by_queue: dict[str, list[JobWorker]] = {}
+        for worker in self.workers:
+            if (queue is None or worker.queue == queue) and worker.takes_priority(priority):
+                by_queue.setdefault(worker.queue, []).append(worker)
+
+        for workers in by_queue.values():
+            idle_worker: Optional[JobWorker] = next((w for w in workers if w.idle), None)
+
+            if idle_worker:
+                idle_worker.wake_up()
+                continue
+
+            for worker in workers:
+                worker.wake_up()
+
+    async def reap(self, app: Quart):
+        """
+        Periodically put jobs of crashed or hung workers back in the queue, prune the job history,
+        and maintain job partitions
+        """
+        assert self._stopping
+
+        while await self._wait_for_stop(timeout=self.reaper_interval) is not self._stopping:
+            # the reaper gets its own request context, not to share a DB connection with the listener
+            async with app.test_request_context("/job_reaper"):
+                setattr(request, "index", "reaper")
+
+                try:
+                    reaped: dict = await jobq.service.job_db.requeue_expired_leases()
+                    metrics.expired_leases.inc("requeued", amount=reaped["requeued"])
+                    metrics.expired_leases.inc("dead", amount=reaped["dead"])
+                except Exception as ex:
+                    logger.error("Failed to requeue jobs with expired leases")
+                    logger.exception(str(ex))
+
+                try:
+                    await jobq.service.job_db.prune_history()
+                except Exception as ex:
+                    logger.error("Failed to prune the job history")
+                    logger.exception(str(ex))
+
+                try:
+                    if jobq.service.job_db.partitioned:
+                        await jobq.service.job_db.maintain_partitions()
+                except Exception as ex:
+                    logger.error("Failed to maintain job partitions")
+                    logger.exception(str(ex))
+
+        logger.info("Job reaper is done")
+
+    async def listen(self):
+        """
+        Keep a dedicated connection LISTENing for saved jobs, reconnecting if it drops.
+        Workers still poll on their interval, so losing the listener only costs latency.
+        """
+        assert self._stopping
+
+        while not self._stopping.is_set():
+            try:
+                conn: Connection = await db.connection_manager.create_listener_connection()
+            except Exception as ex:
+                logger.error("Could not connect the job listener, workers will fall back to polling")
+                logger.exception(str(ex))
+                await self._wait_for_stop(timeout=self.reconnect_interval)
+                continue
+
+            lost = asyncio.Event()
+            conn.add_termination_listener(lambda _: lost.set())
+
+            try:
+                await conn.add_listener(Const.Jobs.NOTIFY_CHANNEL, self._on_notification)
+                logger.info(f"Listening for jobs on [{Const.Jobs.NOTIFY_CHANNEL}]")
+
+                # jobs may have been saved while nobody was listening
+                self.wake_up_workers()
+                await self._arm_ripe_timer_from_db()
+
+                await self._listen_until_stopped(lost)
+            except Exception as ex:
+                logger.exception(str(ex))
+            finally:
+                if not conn.is_closed():
+                    await conn.close()
+
+            if not self._stopping.is_set():
+                logger.warning("Job listener connection lost, reconnecting")
+                await self._wait_for_stop(timeout=self.reconnect_interval)
+
+        logger.info("Job listener is done")
+
+    async def _listen_until_stopped(self, lost: asyncio.Event):
+        assert self._ripe_timer_fired
+
+        # the next ripe time is looked up here rather than in the timer callback, so lookups run one at a time
+        # and never fight over the DB connection of this task
+        while await self._wait_for_stop(lost, self._ripe_timer_fired) is self._ripe_timer_fired:
+            self._ripe_timer_fired.clear()
+            await self._arm_ripe_timer_from_db()
+
+    async def _wait_for_stop(self, *events: asyncio.Event, timeout: Optional[float] = None) -> Optional[asyncio.Event]:
+        """
+        Wait for the stop signal or any of the given events, returning the one that was set first (None on timeout)
+        """
+        assert self._stopping
+
+        waits = {asyncio.create_task(event.wait()): event for event in (self._stopping, *events)}
+        done, pending = await asyncio.wait(waits, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+
+        if self._stopping.is_set():
+            return self._stopping
+        return waits[done.pop()] if done else None
+
+    def _on_notification(self, conn: Connection, pid: int, channel: str, payload: str):
+        # {"queue": <queue>, "delay": <seconds until ripe>, "priority": <highest priority>}
+        try:
+            notification: dict = json.loads(payload)
+            seconds_until_ripe = float(notification.get("delay") or 0)
+            priority: Optional[int] = notification.get("priority")
+            queue: Optional[str] = notification.get("queue")
+        except (ValueError, AttributeError):
+            logger.warning(f"Garbled job notification payload [{payload}]")
+            seconds_until_ripe, priority, queue = 0, None, None
+
+        if seconds_until_ripe > 0:
+            self._arm_ripe_timer(seconds_until_ripe)
+        else:
+            self.wake_up_workers(priority, queue)
+
+    def _arm_ripe_timer(self, seconds_until_ripe: float):
+        # only the earliest scheduled job matters, the next one is looked up when the timer fires
+        loop = asyncio.get_running_loop()
+        when = loop.time() + seconds_until_ripe
+
+        if self._ripe_timer:
+            if self._ripe_timer.when() <= when:
+                return
+            self._ripe_timer.cancel()
+
+        self._ripe_timer = loop.call_at(when, self._on_ripe_timer)
+
+    def _on_ripe_timer(self):
+        self._ripe_timer = None
+        self.wake_up_workers()
+
+        if self._ripe_timer_fired:
+            self._ripe_timer_fired.set()
+
+    async def _arm_ripe_timer_from_db(self):
+        try:
+            next_ripe_at: Optional[datetime.datetime] = await jobq.service.job_db.get_next_ripe_at()
+        except Exception as ex:
+            logger.error("Could not look up the next scheduled job")
+            logger.exception(str(ex))
+            return
+
+        if not next_ripe_at:
+            return
+
+        seconds_until_ripe = (next_ripe_at - datetime.datetime.now(next_ripe_at.tzinfo)).total_seconds()
+        self._arm_ripe_timer(max(seconds_until_ripe, 0))
@@ -0,0 +1,142 @@
+"""
+Runs job workers on their own, without the web server:
+
+    ENV=LOCAL python -m jobq.worker --processes 4
+
+The supervisor forks worker processes, each with its own event loop, DB connection pool and
+WORKERS job workers. Crashed processes are restarted, and SIGTERM (or SIGINT) drains them gracefully.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import signal
+import time
+from multiprocessing.process import BaseProcess
+from typing import Optional
+
+from dotenv import load_dotenv
+
+from jobq import create_app
+from jobq.constants import Const
+from jobq.logger import logger
+
+
+async def serve_workers() -> None:
+    app = create_app()
+    stop = asyncio.Event()
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    # the same startup and shutdown as the web server, minus the serving part
+    await app.startup()
+    logger.info(f"Worker process {os.getpid()} is up")
+
+    await stop.wait()
+
+    logger.info(f"Worker process {os.getpid()} is draining")
+    await app.shutdown()
+
+
+def run_worker_process() -> None:
+    # forget the signal handlers inherited from the supervisor, the event loop sets its own
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+    asyncio.run(serve_workers())
+
+
+class WorkerSupervisor:
+    process_count: int
+    # how long to give worker processes to drain before killing them
+    shutdown_timeout: float
+    # don't restart a crashing process more often than this
+    restart_delay: float = 1
+    processes: list[Optional[BaseProcess]]
+    _stopping: bool
+
+    def __init__(self, process_count: int, shutdown_timeout: float):
+        self.process_count = process_count
+        self.shutdown_timeout = shutdown_timeout
+        self.processes = [None] * process_count
+        self._stopping = False
+
+    def run(self) -> None:
+        signal.signal(signal.SIGTERM, self._on_signal)
+        signal.signal(signal.SIGINT, self._on_signal)
+
+        logger.info(f"Starting {self.process_count} worker processes")
+        last_started: list[float] = [0] * self.process_count
+
+        while not self._stopping:
+            for slot, process in enumerate(self.processes):
+                if process and process.is_alive():
+                    continue
+
+                if time.monotonic() - last_started[slot] < self.restart_delay:
+                    continue
+
+                if process:
+                    logger.error(f"Worker process {process.pid} exited with code {process.exitcode}, restarting")
+
+                self.processes[slot] = self._start_process()
+                last_started[slot] = time.monotonic()
+
+            time.sleep(0.5)
+
+        self._stop_processes()
+
+    def _start_process(self) -> BaseProcess:
+        process = multiprocessing.get_context("fork").Process(target=run_worker_process, daemon=False)
+        process.start()
+        logger.info(f"Started worker process {process.pid}")
+        return process
+
+    def _on_signal(self, signum, _):
+        logger.warning(f"Got signal {signal.Signals(signum).name}, stopping worker processes")
+        self._stopping = True
+
+    def _stop_processes(self) -> None:
+        alive: list[BaseProcess] = [p for p in self.processes if p and p.is_alive()]
+
+        for process in alive:
+            process.terminate()
+
+        deadline = time.monotonic() + self.shutdown_timeout
+        for process in alive:
+            process.join(max(deadline - time.monotonic(), 0))
+
+            if process.is_alive():
+                logger.error(f"Worker process {process.pid} did not drain in time, killing it")
+                process.kill()
+                process.join()
+
+        logger.info("All worker processes have stopped")
+
+
+def main() -> None:
+    if os.environ.get(Const.Config.ENV) == Const.Env.LOCAL:
+        load_dotenv("env/local.env")
+
+    parser = argparse.ArgumentParser(description="Run job workers without the web server")
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=int(os.environ.get(Const.Config.WORKER_PROCESSES, os.cpu_count() or 1)),
+        help="number of worker processes (default: WORKER_PROCESSES, or one per CPU)",
+    )
+    parser.add_argument(
+        "--shutdown-timeout",
+        type=float,
+        default=float(os.environ.get(Const.Config.SHUTDOWN_TIMEOUT, 30)),
+        help="seconds to let worker processes drain on shutdown before killing them",
+    )
+    args = parser.parse_args()
+
+    WorkerSupervisor(args.processes, args.shutdown_timeout).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -23,5 +23,5 @@ port: int = int(os.environ.get(Const.Config.SERVER_PORT))
 
 logger.info(f"Starting server on port {[port]}")
 
-application.run(debug=True, host=host, port=port,
+application.run(debug=bool(int(os.environ.get(Const.Config.DEBUG, 0))), host=host, port=port,
 )
@@ -1,10 +1,13 @@
+import asyncio
 import datetime
 import importlib
 import importlib.resources
+import json
 import os
 import unittest
+from logging.handlers import QueueHandler
 from typing import Optional
-from unittest.mock import patch
+from unittest.mock import AsyncMock, patch
 
 import asyncpg  # type: ignore
 import psycopg2
@@ -18,8 +21,13 @@ from quart import Quart
 import jobq.service
 from jobq import create_app, db
 from jobq.constants import Const
+from jobq.db import DbConnectionManager, JobqConnection, json_codec
 from jobq.job_worker import JobWorker
-from jobq.models.job import Job, JobType
+from jobq.logger import color_handler, core_logger, logger, start_log_queue, stop_log_queue
+from jobq.metrics import Counter, Histogram, metrics
+from jobq.models.job import Job, JobState, JobType
+from jobq.service import JobExecutionService, JobWorkerService
+from jobq.service.job_execution_service import ExecutorType
 
 
 @pytest.mark.asyncio
@@ -60,8 +68,12 @@ class JobsTest(unittest.IsolatedAsyncioTestCase):
             host=os.environ.get(Const.Config.DB.DB_HOST),
             port=os.environ.get(Const.Config.DB.DB_PORT),
             server_settings={"jit": "off"},
+            connection_class=JobqConnection,
         )
 
+        # the hot statements are prepared on the connection, like on a pooled one
+        jobq.service.job_db.configure()
+        await db.connection_manager.init_connection(self.conn)
         db.connection_manager.set_connection(self.conn)
 
         self.transaction = self.conn.transaction()
@@ -283,3 +295,746 @@ class JobsTest(unittest.IsolatedAsyncioTestCase):
 
         await jobq.service.job_db.save(job1)
         await jobq.service.job_db.save(job2)
+
+    async def test_from_db_matches_validation(self):
+        job: Job = await jobq.service.job_db.save(
+            Job(job_type=JobType.JOB_TYPE_1, arguments={"int_arg": 1, "str_arg": "string", "bool_arg": True})
+        )
+
+        row: Optional[dict] = await jobq.service.job_db.execute_with_result("SELECT *, id::text FROM job")
+        assert row
+        # JSONB is decoded by the connection codec
+        assert row["arguments"] == job.arguments
+
+        assert Job.from_db(dict(row)) == Job.model_validate(dict(row, ripe_at=None))
+
+    async def test_json_codec(self):
+        for use_orjson in ("0", "1"):
+            with patch.dict(os.environ, {Const.Config.ORJSON: use_orjson}):
+                encode, decode = json_codec()
+                assert decode(encode({"int_arg": 1, "str_arg": "string"})) == {"int_arg": 1, "str_arg": "string"}
+
+    async def test_save_many(self):
+        already_queued: Job = await jobq.service.job_db.save(Job(job_type=JobType.JOB_TYPE_1, arguments={"int_arg": 0}))
+
+        jobs: list[Job] = [
+            Job(job_type=JobType.JOB_TYPE_1, arguments={"int_arg": 1}),
+            Job(job_type=JobType.JOB_TYPE_1, arguments={"int_arg": 0}),
+            Job(job_type=JobType.JOB_TYPE_2, arguments={"int_arg": 1}).runs_in(hours=1),
+            # a duplicate within the batch
+            Job(job_type=JobType.JOB_TYPE_1, arguments={"int_arg": 1}),
+        ]
+
+        ids: list[str] = await jobq.service.job_db.save_many(jobs)
+        assert len(ids) == len(jobs)
+        assert ids[1] == already_queued.id
+        assert ids[0] == ids[3]
+        assert len(set(ids)) == 3
+
+        saved_jobs: list[Job] = await jobq.service.job_db.get_all_jobs()
+        assert len(saved_jobs) == 3
+
+        scheduled_job: Job = next(job for job in saved_jobs if job.id == ids[2])
+        assert scheduled_job.job_type == JobType.JOB_TYPE_2.value
+        assert scheduled_job.ripe_at
+
+        assert await jobq.service.job_db.save_many([]) == []
+
+    async def test_idempotency_key(self):
+        first: Job = await jobq.service.job_db.save(
+            Job(job_type=JobType.JOB_TYPE_1, arguments={"int_arg": 1}, idempotency_key="order-1")
+        )
+        # same key, different arguments - still the same job
+        second: Job = await jobq.service.job_db.save(
+            Job(job_type=JobType.JOB_TYPE_1, arguments={"int_arg": 2}, idempotency_key="order-1")
+        )
+        # same arguments, no key - a different job
+        third: Job = await jobq.service.job_db.save(Job(job_type=JobType.JOB_TYPE_1, arguments={"int_arg": 1}))
+
+        assert first.id == second.id
+        assert third.id != first.id
+        assert len(await jobq.service.job_db.get_all_jobs()) == 2
+
+    async def test_api_enqueue(self):
+        client = self.app.test_client()
+
+        response = await client.post(
+            "/jobs", json={"job_type": "JOB_TYPE_1", "arguments": {"int_arg": 1}, "priority": 5, "delay_seconds": 60}
+        )
+        assert response.status_code == 201
+        job_id: str = (await response.get_json())["id"]
+
+        response = await client.get(f"/jobs/{job_id}")
+        assert response.status_code == 200
+        job: dict = await response.get_json()
+        assert job["id"] == job_id
+        assert job["priority"] == 5
+        assert job["arguments"] == {"int_arg": 1}
+        assert job["state"] == "scheduled"
+
+        # a batch, with a retried submission that is the same job
+        response = await client.post(
+            "/jobs",
+            json=[
+                {"job_type": "JOB_TYPE_2", "idempotency_key": "a"},
+                {"job_type": "JOB_TYPE_2", "idempotency_key": "b"},
+                {"job_type": "JOB_TYPE_2", "idempotency_key": "a"},
+            ],
+        )
+        assert response.status_code == 201
+        ids: list[str] = (await response.get_json())["ids"]
+        assert len(ids) == 3
+        assert ids[0] == ids[2] != ids[1]
+
+        # a stream, one job per line
+        lines = "\n".join(json.dumps({"job_type": "JOB_TYPE_1", "arguments": {"n": n}}) for n in range(0, 5))
+        response = await client.post("/jobs", data=lines, headers={"Content-Type": "application/x-ndjson"})
+        assert response.status_code == 201
+        assert len((await response.get_json())["ids"]) == 5
+
+        assert len(await jobq.service.job_db.get_all_jobs()) == 8
+
+    async def test_api_rejects_bad_jobs(self):
+        client = self.app.test_client()
+
+        for body in [
+            {"job_type": "NO_SUCH_TYPE"},
+            {"job_type": "JOB_TYPE_1", "tries": 3},
+            {"job_type": "JOB_TYPE_1", "delay_seconds": -1},
+            [{"job_type": "JOB_TYPE_1"}, "garbage"],
+        ]:
+            response = await client.post("/jobs", json=body)
+            assert response.status_code == 400, body
+
+        response = await client.post(
+            "/jobs",
+            data='{"job_type": "JOB_TYPE_1"}\n{"job_type": "JOB_TYPE_1", "arguments": {"n": 1}\n',
+            headers={"Content-Type": "application/x-ndjson"},
+        )
+        assert response.status_code == 400
+        assert "Line 2" in (await response.get_json())["error"]
+
+        response = await client.post("/jobs", data="{", headers={"Content-Type": "application/json"})
+        assert response.status_code == 400
+
+        # all or nothing
+        assert not await jobq.service.job_db.get_all_jobs()
+
+    async def test_api_cancel(self):
+        client = self.app.test_client()
+
+        queued: Job = await jobq.service.job_db.save(Job(job_type=JobType.JOB_TYPE_1, arguments={"int_arg": 1}))
+        running: Job = await jobq.service.job_db.save(Job(job_type=JobType.JOB_TYPE_1, arguments={"int_arg": 2}))
+        await self.conn.execute("UPDATE job SET leased_until = now() + interval '1 minute' WHERE id = $1", running.id)
+
+        assert (await client.delete(f"/jobs/{queued.id}")).status_code == 204
+        assert (await client.delete(f"/jobs/{queued.id}")).status_code == 404
+        assert (await client.get(f"/jobs/{queued.id}")).status_code == 404
+        assert (await client.delete(f"/jobs/{running.id}")).status_code == 409
+        assert (await client.get("/jobs/not-a-uuid")).status_code == 404
+
+        response = await client.get(f"/jobs/{running.id}")
+        assert (await response.get_json())["state"] == "running"
+
+    async def test_api_finished_job(self):
+        job: Job = await jobq.service.job_db.save(Job(job_type=JobType.JOB_TYPE_1))
+        await JobWorker(worker_id=0, app=self.app).pull_and_execute()
+
+        response = await self.app.test_client().get(f"/jobs/{job.id}")
+        assert response.status_code == 200
+        finished: dict = await response.get_json()
+        assert finished["state"] == "completed"
+        assert finished["tries"] == 1
+
+    async def test_histogram(self):
+        histogram = Histogram("test_seconds", "Test", ("job_type",), buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value, 'JOB "1"')
+
+        assert histogram.samples() == [
+            'test_seconds_bucket{job_type="JOB \\"1\\"",le="0.1"} 2.0',
+            'test_seconds_bucket{job_type="JOB \\"1\\"",le="1"} 3.0',
+            'test_seconds_bucket{job_type="JOB \\"1\\"",le="+Inf"} 4.0',
+            'test_seconds_sum{job_type="JOB \\"1\\""} 3.65',
+            'test_seconds_count{job_type="JOB \\"1\\""} 4.0',
+        ]
+
+    async def test_worker_metrics(self):
+        def count(counter: Counter, *labels: str) -> float:
+            return counter.values.get(labels, 0)
+
+        jobs_before: float = count(metrics.jobs, "JOB_TYPE_2", "failed")
+        retries_before: float = count(metrics.retries, "JOB_TYPE_2")
+        dead_before: float = count(metrics.dead_letters, "JOB_TYPE_2")
+        empty_before: float = count(metrics.empty_polls, Const.Jobs.DEFAULT_QUEUE)
+
+        await jobq.service.job_db.save(Job(job_type=JobType.JOB_TYPE_2, max_retries=1, base_retry_minutes=0))
+        worker = JobWorker(worker_id=0, app=self.app)
+
+        with patch("jobq.service.job_execution.execute", side_effect=ValueError("LOL")):
+            await worker.pull_and_execute()
+            await worker.pull_and_execute()
+            await worker.pull_and_execute()
+
+        assert count(metrics.jobs, "JOB_TYPE_2", "failed") == jobs_before + 2
+        assert count(metrics.retries, "JOB_TYPE_2") == retries_before + 1
+        assert count(metrics.dead_letters, "JOB_TYPE_2") == dead_before + 1
+        assert count(metrics.empty_polls, Const.Jobs.DEFAULT_QUEUE) == empty_before + 1
+        assert metrics.job_seconds.values[("JOB_TYPE_2",)][-1] >= 0
+
+    async def test_metrics_endpoint(self):
+        await self.conn.execute(
+            """
+            INSERT INTO job (job_type, arguments, max_retries, base_retry_minutes, created_at)
+                 VALUES ('JOB_TYPE_1', '{}', 3, 20, now() - interval '1 minute')
+            """
+        )
+        metrics.sampled_at = None
+
+        response = await self.app.test_client().get("/metrics")
+        assert response.status_code == 200
+
+        text: str = await response.get_data(as_text=True)
+        assert "# TYPE jobq_claim_seconds histogram" in text
+        assert 'jobq_queued_jobs{state="ripe"} 1' in text
+        assert metrics.oldest_ripe_job_seconds.values[()] >= 60
+
+    async def test_empty_polls_are_logged_once_in_a_while(self):
+        worker = JobWorker(worker_id=0, app=self.app)
+        worker.sound_off_every_cycles = 2
+
+        with patch.object(worker.logger, "info") as log:
+            for _ in range(0, 3):
+                assert not await worker.pull_and_execute()
+
+        empty_poll_lines = [c.args[0] for c in log.call_args_list if c.args[0].startswith("No ripe jobs")]
+        assert len(empty_poll_lines) == 2
+        assert "3 empty polls" in empty_poll_lines[-1]
+
+    async def test_log_queue(self):
+        start_log_queue()
+        try:
+            assert any(isinstance(h, QueueHandler) for h in core_logger.handlers)
+            logger.info("Through the queue")
+        finally:
+            stop_log_queue()
+
+        assert core_logger.handlers == [color_handler]
+
+    async def test_hot_statements_are_prepared(self):
+        prepared: set[str] = {
+            r["name"] for r in await self.conn.fetch("SELECT name FROM pg_prepared_statements WHERE name LIKE 'jobq_%'")
+        }
+        assert prepared == {"jobq_claim", "jobq_save", "jobq_release"}
+
+        job: Job = await jobq.service.job_db.save(Job(job_type=JobType.JOB_TYPE_1))
+        with patch.object(self.conn, "fetch", side_effect=AssertionError("not prepared")):
+            claimed: Optional[Job] = await jobq.service.job_db.get_one_ripe_job(worker_id="worker")
+            assert claimed
+            assert claimed.id == job.id
+
+            claimed.completed = True
+            await jobq.service.job_db.release_jobs([claimed], [], "worker")
+
+        assert not await jobq.service.job_db.get_all_jobs()
+
+    async def test_prepared_statements_can_be_turned_off(self):
+        manager = DbConnectionManager()
+        manager.register_statement("jobq_test", "SELECT 1")
+
+        with patch.dict(os.environ, {Const.Config.PREPARED_STATEMENTS: "off"}):
+            await manager.create_connection_pool()
+
+        try:
+            assert manager.conn_pool
+            async with manager.conn_pool.acquire() as conn:
+                assert conn.prepared == {}
+                await conn.fetch("SELECT 1")
+                # not even asyncpg's own cached statements, which are named too
+                assert not await conn.fetchval("SELECT count(*) FROM pg_prepared_statements")
+        finally:
+            await manager.close_connection_pool()
+
+    async def test_claim_ripe_jobs_in_batches(self):
+        for arg in range(0, 3):
+            await jobq.service.job_db.save(Job(job_type=JobType.JOB_TYPE_1, arguments={"int_arg": arg}))
+
+        await jobq.service.job_db.save(Job(job_type=JobType.JOB_TYPE_2).runs_in(hours=1))
+
+        jobs: list[Job] = await jobq.service.job_db.claim_ripe_jobs(2)
+        assert len(jobs) == 2
+
+        # only one ripe job left
+        jobs = await jobq.service.job_db.claim_ripe_jobs(10)
+        assert len(jobs) == 1
+
+        jobs = await jobq.service.job_db.claim_ripe_jobs(10)
+        assert not jobs
+
+    async def test_batch_retries(self):
+        for arg in range(0, 3):
+            await jobq.service.job_db.save(
+                Job(job_type=JobType.JOB_TYPE_1, arguments={"int_arg": arg}, base_retry_minutes=0, max_retries=1)
+            )
+
+        worker = JobWorker(worker_id=0, app=self.app)
+        worker.batch_size = 10
+
+        with patch("jobq.service.job_execution.execute", side_effect=AssertionError("LOL")):
+            processed_jobs: list[Job] = await worker.pull_and_execute_batch()
+            assert len(processed_jobs) == 3
+            assert all(job.tries == 1 for job in processed_jobs)
+
+            # all jobs are back in the queue for their last retry
+            processed_jobs = await worker.pull_and_execute_batch()
+            assert len(processed_jobs) == 3
+            assert all(job.tries == 2 for job in processed_jobs)
+
+        processed_jobs = await worker.pull_and_execute_batch()
+        assert not processed_jobs
+
+    async def test_claim_by_priority(self):
+        low: Job = await jobq.service.job_db.save(Job(job_type=JobType.JOB_TYPE_1, arguments={"int_arg": 1}))
+        high: Job = await jobq.service.job_db.save(
+            Job(job_type=JobType.JOB_TYPE_1, arguments={"int_arg": 2}, priority=10)
+        )
+        # saving a queued job again with a higher priority bumps it up
+        bumped: Job = await jobq.service.job_db.save(
+            Job(job_type=JobType.JOB_TYPE_1, arguments={"int_arg": 3}, priority=5)
+        )
+        await jobq.service.job_db.save(Job(job_type=JobType.JOB_TYPE_1, arguments={"int_arg": 3}, priority=20))
+
+        # a worker with a priority floor leaves the low-priority job alone
+        jobs: list[Job] = await jobq.service.job_db.claim_ripe_jobs(10, "urgent", min_priority=10)
+        assert [job.id for job in jobs] == [bumped.id, high.id]
+        assert jobs[0].priority == 20
+
+        jobs = await jobq.service.job_db.claim_ripe_jobs(10, "worker")
+        assert [job.id for job in jobs] == [low.id]
+
+    async def test_queues(self):
+        jobs: list[Job] = [
+            Job(job_type=JobType.JOB_TYPE_1, arguments={"int_arg": 1}, base_retry_minutes=0),
+            Job(job_type=JobType.JOB_TYPE_2, arguments={"int_arg": 1}, base_retry_minutes=0, queue="slow"),
+            Job(job_type=JobType.JOB_TYPE_2, arguments={"int_arg": 2}, base_retry_minutes=0, queue="slow"),
+        ]
+        await jobq.service.job_db.save_many(jobs)
+
+        slow_jobs: list[Job] = await jobq.service.job_db.claim_ripe_jobs(10, "slow-worker", queue="slow")
+        assert len(slow_jobs) == 2
+        assert all(job.queue == "slow" for job in slow_jobs)
+
+        default_jobs: list[Job] = await jobq.service.job_db.claim_ripe_jobs(10, "worker")
+        assert len(default_jobs) == 1
+        assert default_jobs[0].queue == Const.Jobs.DEFAULT_QUEUE
+
+        # retries go back to their own queue
+        for job in slow_jobs + default_jobs:
+            job.update_for_next_retry()
+        await jobq.service.job_db.release_jobs([], slow_jobs, "slow-worker")
+        await jobq.service.job_db.release_jobs([], default_jobs, "worker")
+        assert len(await jobq.service.job_db.claim_ripe_jobs(10, "slow-worker", queue="slow")) == 2
+
+    async def test_worker_groups(self):
+        worker_groups = {"slow": {"WORKERS": 1, "CONCURRENCY": 4, "POLLING_INTERVAL": 30}}
+        env = {Const.Config.WORKER_COUNT: "2", Const.Config.WORKER_GROUPS: json.dumps(worker_groups)}
+
+        service = JobWorkerService()
+        service.workers = []
+
+        with patch.dict(os.environ, env), patch.object(self.app, "add_background_task"):
+            service.start(self.app)
+
+        assert [(w.worker_id, w.queue) for w in service.workers] == [(1, "slow"), (2, "default"), (3, "default")]
+        slow_worker: JobWorker = service.workers[0]
+        assert slow_worker.concurrency == 4
+        assert slow_worker.polling_interval == 30
+        assert service.workers[1].polling_interval == float(os.environ.get(Const.Config.POLLING_INTERVAL, 5))
+
+        for worker in service.workers:
+            worker.idle = True
+
+        # a notification only wakes up a worker of the job's queue
+        service._on_notification(
+            self.conn, 0, Const.Jobs.NOTIFY_CHANNEL, '{"queue": "slow", "delay": 0, "priority": 0}'
+        )
+        assert [w._wake_up.is_set() for w in service.workers] == [True, False, False]
+
+        # not knowing the queue, one worker of each queue is woken up
+        slow_worker._wake_up.clear()
+        service.wake_up_workers()
+        assert [w._wake_up.is_set() for w in service.workers] == [True, True, False]
+
+    async def test_claim_scan_uses_the_claim_index(self):
+        # a big backlog of ripe bulk jobs, and a few urgent ones that must not wait for it to drain
+        await self.conn.execute(
+            """
+            INSERT INTO job (job_type, arguments, ripe_at, max_retries, base_retry_minutes)
+                 SELECT 'JOB_TYPE_1', jsonb_build_object('n', n), now() - n * interval '1 second', 3, 20
+                   FROM generate_series(1, 50000) AS n
+            """
+        )
+        for arg in range(0, 10):
+            await jobq.service.job_db.save(Job(job_type=JobType.JOB_TYPE_2, arguments={"int_arg": arg}, priority=10))
+        await self.conn.execute("ANALYZE job")
+
+        plan: str = await self.conn.fetchval(
+            f"EXPLAIN (FORMAT JSON) {jobq.service.job_db.CLAIM_RIPE_JOBS}",
+            datetime.datetime.now(),
+            10,
+            Const.Jobs.LEASE_SECONDS,
+            "worker",
+            None,
+            Const.Jobs.DEFAULT_QUEUE,
+        )
+
+        def index_names(node: dict) -> set[str]:
+            names = {node["Index Name"]} if "Index Name" in node else set()
+            for child in node.get("Plans", []):
+                names |= index_names(child)
+            return names
+
+        # walked in claim order, no sorting of the backlog
+        assert "job_claim_idx" in index_names(json.loads(plan)[0]["Plan"])
+        assert "Sort" not in plan
+
+    async def test_jobs_page(self):
+        now = datetime.datetime.now()
+        immediate: Job = await jobq.service.job_db.save(Job(job_type=JobType.JOB_TYPE_1, arguments={"int_arg": 0}))
+        scheduled: list[Job] = [
+            await jobq.service.job_db.save(
+                Job(
+                    job_type=JobType.JOB_TYPE_2, arguments={"int_arg": arg}, ripe_at=now + datetime.timedelta(hours=arg)
+                )
+            )
+            for arg in range(1, 4)
+        ]
+        running: Job = await jobq.service.job_db.save(Job(job_type=JobType.JOB_TYPE_1, arguments={"int_arg": 9}))
+        assert await jobq.service.job_db.get_one_ripe_job(worker_id="worker", lease_seconds=60)
+
+        # queued jobs in the order they are ripe, two at a time
+        pages: list[list[str]] = []
+        cursor: Optional[str] = None
+        while True:
+            jobs, cursor = await jobq.service.job_db.get_jobs_page(limit=2, after=cursor)
+            pages.append([j.id for j in jobs])  # type: ignore
+            if not cursor:
+                break
+
+        claimed: str = running.id if immediate.id in pages[0] else immediate.id  # type: ignore
+        queued: str = immediate.id if claimed == running.id else running.id  # type: ignore
+        assert pages == [[queued, scheduled[0].id], [scheduled[1].id, scheduled[2].id]]
+
+        jobs, cursor = await jobq.service.job_db.get_jobs_page(state=JobState.SCHEDULED, job_type="JOB_TYPE_2", limit=3)
+        assert [j.id for j in jobs] == [j.id for j in scheduled]
+        assert not cursor
+
+        jobs, _ = await jobq.service.job_db.get_jobs_page(state=JobState.RIPE)
+        assert [j.id for j in jobs] == [queued]
+
+        jobs, _ = await jobq.service.job_db.get_jobs_page(state=JobState.RUNNING)
+        assert [j.id for j in jobs] == [claimed]
+
+        counts: dict = await jobq.service.job_db.get_job_counts()
+        assert counts == {"queued": 4, "ripe": 1, "scheduled": 3, "running": 1, "estimated": False}
+
+        # the immediate job has no ripe time to show
+        async with self.app.test_request_context("/"):
+            page: str = await quart.render_template(
+                "index.html",
+                jobs=jobs + [Job(job_type=JobType.JOB_TYPE_1)],
+                counts=counts,
+                workers=[],
+                states=list(JobState),
+                job_types=list(JobType),
+                state=JobState.QUEUED,
+                job_type=None,
+                next_page=None,
+                time="00:00:00",
+            )
+        assert "<span>now</span>" in page
+
+    async def test_job_counts_are_estimated_for_big_tables(self):
+        await self.conn.execute(
+            """
+            INSERT INTO job (job_type, arguments, max_retries, base_retry_minutes)
+                 SELECT 'JOB_TYPE_1', jsonb_build_object('n', n), 3, 20 FROM generate_series(1, 1000) AS n
+            """
+        )
+        await self.conn.execute("ANALYZE job")
+
+        service = jobq.service.JobDbService()
+        service.exact_count_limit = 100
+
+        counts: dict = await service.get_job_counts()
+        assert counts["estimated"]
+        assert counts["queued"] == 1000
+        assert counts["running"] == 0
+
+    async def test_jobs_page_uses_the_ripe_index(self):
+        await self.conn.execute(
+            """
+            INSERT INTO job (job_type, arguments, ripe_at, max_retries, base_retry_minutes)
+                 SELECT 'JOB_TYPE_1', jsonb_build_object('n', n), now() + n * interval '1 second', 3, 20
+                   FROM generate_series(1, 50000) AS n
+            """
+        )
+        await self.conn.execute("ANALYZE job")
+
+        jobs, cursor = await jobq.service.job_db.get_jobs_page(limit=50)
+        assert cursor
+
+        plan: str = await self.conn.fetchval(
+            """
+            EXPLAIN (FORMAT JSON)
+             SELECT * FROM job
+              WHERE leased_until IS NULL AND (ripe_at, id) > ($2::text::timestamptz, $3::uuid)
+           ORDER BY ripe_at, id
+              LIMIT $1
+            """,
+            51,
+            *cursor.rsplit(",", 1),
+        )
+
+        # a deep page is a range scan, not a sort of the whole queue
+        assert "job_ripe_idx" in plan
+        assert "Sort" not in plan
+
+    async def test_leased_job_is_not_claimed_again(self):
+        await jobq.service.job_db.save(Job(job_type=JobType.JOB_TYPE_1))
+
+        job: Optional[Job] = await jobq.service.job_db.get_one_ripe_job(worker_id="worker-1")
+        assert job
+        assert job.worker_id == "worker-1"
+        assert job.leased_until
+
+        assert not await jobq.service.job_db.get_one_ripe_job(worker_id="worker-2")
+
+        # the job stays in the table until its worker is done with it
+        jobs: list[Job] = await jobq.service.job_db.get_all_jobs()
+        assert len(jobs) == 1
+
+        await jobq.service.job_db.release_jobs([job], [], "worker-1")
+        assert not await jobq.service.job_db.get_all_jobs()
+
+    async def test_expired_lease_is_requeued(self):
+        job: Job = await jobq.service.job_db.save(Job(job_type=JobType.JOB_TYPE_1, max_retries=1))
+        now = datetime.datetime.now()
+
+        assert await jobq.service.job_db.get_one_ripe_job(worker_id="doomed-worker", lease_seconds=60)
+
+        # the lease is still good
+        result: dict = await jobq.service.job_db.requeue_expired_leases()
+        assert result["requeued"] == 0
+
+        with freeze_time(now + datetime.timedelta(minutes=2)):
+            result = await jobq.service.job_db.requeue_expired_leases()
+            assert result["requeued"] == 1
+
+            requeued_job: Optional[Job] = await jobq.service.job_db.get_one_ripe_job(
+                worker_id="doomed-worker", lease_seconds=60
+            )
+            assert requeued_job
+            assert requeued_job.id == job.id
+            # the crash counts as a try
+            assert requeued_job.tries == 1
+
+            # the late worker cannot release a job that was handed to someone else
+            await jobq.service.job_db.release_jobs([job], [], "zombie-worker")
+            assert len(await jobq.service.job_db.get_all_jobs()) == 1
+
+        with freeze_time(now + datetime.timedelta(minutes=4)):
+            # crashed again, and this time it's out of retries
+            result = await jobq.service.job_db.requeue_expired_leases()
+            assert result["dead"] == 1
+            assert not await jobq.service.job_db.get_all_jobs()
+
+    async def test_finished_jobs_are_archived(self):
+        done: Job = await jobq.service.job_db.save(Job(job_type=JobType.JOB_TYPE_1, arguments={"int_arg": 1}))
+        dead: Job = await jobq.service.job_db.save(Job(job_type=JobType.JOB_TYPE_2, max_retries=0))
+
+        worker = JobWorker(worker_id=0, app=self.app)
+        worker.batch_size = 10
+
+        def execute(job: Job):
+            if job.id == dead.id:
+                raise ValueError("LOL")
+
+        with patch("jobq.service.job_execution.execute", side_effect=execute):
+            await worker.pull_and_execute_batch()
+
+        assert not await jobq.service.job_db.get_all_jobs()
+
+        history: dict = {
+            str(row["id"]): row for row in await self.conn.fetch("SELECT * FROM job_history ORDER BY finished_at")
+        }
+        assert history[done.id]["status"] == "completed"
+        assert history[done.id]["arguments"] == {"int_arg": 1}
+        assert history[done.id]["tries"] == 1
+        assert history[done.id]["duration_ms"] is not None
+        assert history[done.id]["error"] is None
+
+        assert history[dead.id]["status"] == "dead"
+        assert history[dead.id]["error"] == "ValueError: LOL"
+
+        dead_letters: list[dict] = await jobq.service.job_db.get_dead_letters()
+        assert [d["id"] for d in dead_letters] == [dead.id]
+
+    async def test_requeue_dead_letters(self):
+        dead: Job = await jobq.service.job_db.save(Job(job_type=JobType.JOB_TYPE_2, max_retries=0, priority=3))
+
+        worker = JobWorker(worker_id=0, app=self.app)
+        with patch("jobq.service.job_execution.execute", side_effect=ValueError("LOL")):
+            await worker.pull_and_execute()
+
+        ids: list[str] = await jobq.service.job_db.requeue_dead_letters([dead.id])
+        assert len(ids) == 1
+        assert not await jobq.service.job_db.get_dead_letters()
+
+        requeued_job: Optional[Job] = await worker.pull_and_execute()
+        assert requeued_job
+        assert requeued_job.id == ids[0]
+        # a fresh set of retries
+        assert requeued_job.tries == 0
+        assert requeued_job.max_retries == 0
+        assert requeued_job.priority == 3
+        assert requeued_job.completed
+
+    async def test_prune_history(self):
+        await self.conn.executemany(
+            """
+            INSERT INTO job_history (id, job_type, arguments, queue, priority, max_retries, base_retry_minutes, tries,
+                                     status, created_at, finished_at, duration_ms)
+                 VALUES (gen_random_uuid(), 'JOB_TYPE_1', '{}', 'default', 0, 0, 0, 1,
+                         $1, now() - interval '60 days', now() - make_interval(days => $2), 10)
+            """,
+            [("completed", 8), ("completed", 8), ("completed", 1), ("dead", 8), ("dead", 31)],
+        )
+
+        service = jobq.service.JobDbService()
+        service.history_batch_size = 1
+
+        # the old completed jobs and the really old dead one go, in batches of one
+        assert await service.prune_history() == 3
+        assert await self.conn.fetchval("SELECT count(*) FROM job_history") == 2
+
+        rollup: list = await self.conn.fetch("SELECT status, jobs, duration_ms FROM job_history_rollup ORDER BY 1")
+        assert [tuple(r) for r in rollup] == [("completed", 2, 20), ("dead", 1, 10)]
+
+        # nothing left to prune
+        assert await service.prune_history() == 0
+
+    async def test_worker_drains_the_queue_before_backing_off(self):
+        worker = JobWorker(worker_id=0, app=self.app)
+        pulls: list[list[Job]] = [[Job(job_type=JobType.JOB_TYPE_1)], [Job(job_type=JobType.JOB_TYPE_2)], []]
+        waits: list[float] = []
+
+        async def wait(timeout: float):
+            waits.append(timeout)
+            worker.request_stop()
+
+        with patch.object(worker, "pull_and_execute_batch", side_effect=pulls), patch.object(worker, "wait", wait):
+            await worker.run()
+
+        # no sleeping between the pulls that returned jobs, and a short backoff after the first empty one
+        assert len(waits) == 1
+        assert waits[0] <= worker.backoff_base
+
+    async def test_worker_runs_jobs_concurrently(self):
+        for arg in range(0, 5):
+            await jobq.service.job_db.save(Job(job_type=JobType.JOB_TYPE_1, arguments={"int_arg": arg}))
+
+        worker = JobWorker(worker_id=0, app=self.app)
+        worker.concurrency = 3
+        worker.batch_size = 10
+        running: list[Job] = []
+        most_running = 0
+
+        async def execute(job: Job):
+            nonlocal most_running
+            running.append(job)
+            most_running = max(most_running, len(running))
+            await asyncio.sleep(0.05)
+            running.remove(job)
+
+        # jobs in flight release themselves through their own pooled connections, which the test does not have
+        with patch("jobq.service.job_execution.execute", execute), patch(
+            "jobq.service.job_db.release_jobs", new_callable=AsyncMock
+        ) as release_jobs:
+            dispatched: list[Job] = await worker.pull_and_dispatch()
+            assert len(dispatched) == 3
+
+            # no free slots until a job is done
+            assert not await worker.pull_and_dispatch()
+
+            await worker._wait_for_free_slot()
+            dispatched = await worker.pull_and_dispatch()
+            assert dispatched
+
+            await worker.drain()
+
+        assert most_running == 3
+        assert release_jobs.await_count == 3 + len(dispatched)
+
+    async def test_backoff_is_capped_at_the_polling_interval(self):
+        worker = JobWorker(worker_id=0, app=self.app)
+        worker.backoff_jitter = 0
+
+        assert worker.backoff(1) == worker.backoff_base
+        assert worker.backoff(2) == worker.backoff_base * 2
+        assert worker.backoff(100) == worker.polling_interval
+
+    async def test_job_executors(self):
+        with patch.dict(os.environ, {Const.Config.JOB_EXECUTORS: "JOB_TYPE_1=thread, JOB_TYPE_2=process"}):
+            service = JobExecutionService()
+            service.configure()
+
+        assert service.executor_for(JobType.JOB_TYPE_1.value) == ExecutorType.THREAD
+        assert service.executor_for(JobType.JOB_TYPE_2.value) == ExecutorType.PROCESS
+
+        try:
+            await service.execute(Job(job_type=JobType.JOB_TYPE_1))
+            await service.execute(Job(job_type=JobType.JOB_TYPE_2))
+
+            # a failure in the pool comes back to the worker, to schedule a retry
+            with patch("jobq.service.job_execution_service.run_job", side_effect=RuntimeError("LOL")):
+                with pytest.raises(RuntimeError):
+                    await service.execute(Job(job_type=JobType.JOB_TYPE_1))
+        finally:
+            service.shutdown()
+
+    async def test_notification_wakes_up_an_idle_worker(self):
+        busy_worker = JobWorker(worker_id=1, app=self.app)
+        idle_worker = JobWorker(worker_id=2, app=self.app)
+        idle_worker.idle = True
+
+        service = JobWorkerService()
+        service.workers = [busy_worker, idle_worker]
+
+        # a job in the future only arms the timer
+        service._on_notification(self.conn, 0, Const.Jobs.NOTIFY_CHANNEL, '{"delay": 3600, "priority": 0}')
+        assert service._ripe_timer
+        assert not idle_worker._wake_up.is_set()
+        service._ripe_timer.cancel()
+
+        service._on_notification(self.conn, 0, Const.Jobs.NOTIFY_CHANNEL, '{"delay": 0, "priority": 0}')
+        assert idle_worker._wake_up.is_set()
+        assert not busy_worker._wake_up.is_set()
+
+    async def test_notification_skips_workers_above_the_priority(self):
+        urgent_worker = JobWorker(worker_id=1, app=self.app, min_priority=10)
+        urgent_worker.idle = True
+        worker = JobWorker(worker_id=2, app=self.app)
+        worker.idle = True
+
+        service = JobWorkerService()
+        service.workers = [urgent_worker, worker]
+
+        service._on_notification(self.conn, 0, Const.Jobs.NOTIFY_CHANNEL, '{"delay": 0, "priority": 5}')
+        assert not urgent_worker._wake_up.is_set()
+        assert worker._wake_up.is_set()
+
+        worker._wake_up.clear()
+        service._on_notification(self.conn, 0, Const.Jobs.NOTIFY_CHANNEL, '{"delay": 0, "priority": 10}')
+        assert urgent_worker._wake_up.is_set()
+        assert not worker._wake_up.is_set()
@@ -0,0 +1,178 @@
+import datetime
+import importlib
+import importlib.resources
+import os
+import unittest
+from typing import Optional
+
+import asyncpg  # type: ignore
+import psycopg2
+import pytest
+import quart
+from asyncpg import Connection
+from asyncpg.transaction import Transaction  # type: ignore
+from freezegun import freeze_time
+from quart import Quart
+
+from jobq import create_app, db
+from jobq.constants import Const
+from jobq.models.job import Job, JobType
+from jobq.service import JobDbService
+
+
+@pytest.mark.asyncio
+class PartitionsTest(unittest.IsolatedAsyncioTestCase):
+    """
+    The job table in partitions (schema_partitioned.sql)
+    """
+
+    conn: Connection
+    transaction: Transaction
+    job_db: JobDbService
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        conn = psycopg2.connect(
+            database=os.environ.get(Const.Config.DB.DB_NAME),
+            user=os.environ.get(Const.Config.DB.DB_USER),
+            password=os.environ.get(Const.Config.DB.DB_PASSWORD),
+            host=os.environ.get(Const.Config.DB.DB_HOST),
+            port=os.environ.get(Const.Config.DB.DB_PORT),
+        )
+
+        sql = importlib.resources.files("jobq").joinpath("schema_partitioned.sql").read_text()
+
+        with conn.cursor() as cur:
+            cur.execute("".join(sql))  # type: ignore
+            conn.commit()
+        conn.close()
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        # leave the regular schema behind for whoever is next
+        conn = psycopg2.connect(
+            database=os.environ.get(Const.Config.DB.DB_NAME),
+            user=os.environ.get(Const.Config.DB.DB_USER),
+            password=os.environ.get(Const.Config.DB.DB_PASSWORD),
+            host=os.environ.get(Const.Config.DB.DB_HOST),
+            port=os.environ.get(Const.Config.DB.DB_PORT),
+        )
+
+        sql = importlib.resources.files("jobq").joinpath("schema.sql").read_text()
+
+        with conn.cursor() as cur:
+            cur.execute("".join(sql))  # type: ignore
+            conn.commit()
+        conn.close()
+
+    async def asyncSetUp(self) -> None:
+        self.app: Quart = create_app()
+
+        self.ctx: quart.ctx.AppContext = self.app.app_context()
+        await self.ctx.push()
+
+        self.conn = await asyncpg.connect(
+            database=os.environ.get(Const.Config.DB.DB_NAME),
+            user=os.environ.get(Const.Config.DB.DB_USER),
+            password=os.environ.get(Const.Config.DB.DB_PASSWORD),
+            host=os.environ.get(Const.Config.DB.DB_HOST),
+            port=os.environ.get(Const.Config.DB.DB_PORT),
+            server_settings={"jit": "off"},
+        )
+
+        await db.connection_manager.init_connection(self.conn)
+        db.connection_manager.set_connection(self.conn)
+
+        self.transaction = self.conn.transaction()
+        await self.transaction.start()
+
+        self.job_db = JobDbService()
+        self.job_db.partitioned = True
+        self.job_db.partitions_ahead = 2
+
+    async def asyncTearDown(self) -> None:
+        await self.transaction.rollback()
+        await self.conn.close()
+        await self.ctx.pop()
+
+    async def partition_of(self, job_id: Optional[str]) -> str:
+        return await self.conn.fetchval("SELECT tableoid::regclass::text FROM job WHERE id = $1", job_id)
+
+    async def test_maintain_partitions(self):
+        result: dict = await self.job_db.maintain_partitions()
+        assert result == {"created": 3, "dropped": 0}
+
+        partitions: list[dict] = await self.job_db.get_partitions()
+        assert len(partitions) == 3
+        assert all(p["upper"] - p["lower"] == datetime.timedelta(hours=1) for p in partitions)
+
+        # nothing to do the second time around
+        assert await self.job_db.maintain_partitions() == {"created": 0, "dropped": 0}
+
+    async def test_save_and_claim(self):
+        await self.job_db.maintain_partitions()
+        current: str = min((await self.job_db.get_partitions()), key=lambda p: p["lower"])["name"]
+
+        job: Job = await self.job_db.save(Job(job_type=JobType.JOB_TYPE_1, arguments={"int_arg": 1}))
+        # immediate jobs go into the current partition
+        assert await self.partition_of(job.id) == current
+
+        far_job: Job = await self.job_db.save(
+            Job(job_type=JobType.JOB_TYPE_1, arguments={"int_arg": 2}).runs_in(hours=24 * 7)
+        )
+        assert await self.partition_of(far_job.id) == "job_default"
+
+        # no unique index to conflict on, but still no duplicates
+        same_job: Job = await self.job_db.save(Job(job_type=JobType.JOB_TYPE_1, arguments={"int_arg": 1}, priority=5))
+        assert same_job.id == job.id
+        ids: list[str] = await self.job_db.save_many(
+            [
+                Job(job_type=JobType.JOB_TYPE_1, arguments={"int_arg": 1}),
+                Job(job_type=JobType.JOB_TYPE_2, arguments={"int_arg": 1}),
+                Job(job_type=JobType.JOB_TYPE_2, arguments={"int_arg": 1}),
+            ]
+        )
+        assert ids[0] == job.id
+        assert ids[1] == ids[2]
+        assert len(await self.job_db.get_all_jobs()) == 3
+
+        jobs: list[Job] = await self.job_db.claim_ripe_jobs(10, "worker")
+        assert [j.id for j in jobs] == [job.id, ids[1]]
+        assert jobs[0].priority == 5
+
+        # a retry moves the job to a later partition
+        jobs[0].tries = 1
+        jobs[0].ripe_at = datetime.datetime.now() + datetime.timedelta(hours=1)
+        await self.job_db.release_jobs([jobs[1]], [jobs[0]], "worker")
+        assert await self.partition_of(job.id) != current
+
+    async def test_drained_partitions_are_dropped(self):
+        with freeze_time(datetime.datetime.now() - datetime.timedelta(hours=3)):
+            await self.job_db.maintain_partitions()
+        assert len(await self.job_db.get_partitions()) == 3
+
+        # a stuck job from two hours ago keeps its partition around
+        stuck_job: Job = Job(job_type=JobType.JOB_TYPE_1, arguments={"int_arg": 1})
+        stuck_job.ripe_at = datetime.datetime.now() - datetime.timedelta(hours=2)
+        stuck_job = await self.job_db.save(stuck_job)
+        stuck_partition: str = await self.partition_of(stuck_job.id)
+
+        result: dict = await self.job_db.maintain_partitions()
+        assert result["dropped"] == 2
+
+        names: list[str] = [p["name"] for p in await self.job_db.get_partitions()]
+        assert stuck_partition in names
+        assert len(names) == 1 + 3
+
+    async def test_jobs_are_moved_out_of_the_default_partition(self):
+        await self.job_db.maintain_partitions()
+
+        job: Job = Job(job_type=JobType.JOB_TYPE_1, arguments={"int_arg": 1})
+        job.ripe_at = datetime.datetime.now() + datetime.timedelta(hours=5)
+        job = await self.job_db.save(job)
+        assert await self.partition_of(job.id) == "job_default"
+
+        with freeze_time(datetime.datetime.now() + datetime.timedelta(hours=4)):
+            await self.job_db.maintain_partitions()
+
+        assert await self.partition_of(job.id) != "job_default"